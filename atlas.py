@@ -0,0 +1,151 @@
+import argparse
+import json
+import os
+from dataclasses import asdict, dataclass, replace
+from fnmatch import fnmatch
+from functools import lru_cache
+from itertools import groupby
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+from PIL import Image
+from rich.progress import track
+
+from manifest import BAKED_PATH, BakedTitle, load_manifest
+
+ATLAS_DIRECTORY = 'atlas'
+ATLAS_PATH = os.path.join(BAKED_PATH, ATLAS_DIRECTORY)
+ATLAS_INDEX_PATH = os.path.join(ATLAS_PATH, 'index.json')
+ATLAS_MAX_SIZE = 4096  # Largest width or height of a sheet in pixels
+ATLAS_VERSION = 1
+
+
+@dataclass
+class AtlasEntry:
+    '''Where a baked title is in the atlas sheets.'''
+    sheet: str  # Relative to BAKED_PATH, '/' separated
+    x: int
+    y: int
+    width: int
+    height: int
+    inputHash: str | None = None  # Input hash of the title when the sheet was built
+
+    def get_box(self) -> Tuple[int, int, int, int]:
+        return (self.x, self.y, self.x + self.width, self.y + self.height)
+
+
+def load_index(path: str = ATLAS_INDEX_PATH) -> Dict[str, AtlasEntry]:
+    '''Returns the atlas entry of every title, by manifest path. Empty if there is no index or it is from an older version.'''
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r', encoding='utf8') as f:
+        index = json.load(f)
+    if index.get('version') != ATLAS_VERSION:
+        return {}
+    return {p: AtlasEntry(**e) for p, e in index['titles'].items()}
+
+
+def save_index(entries: Dict[str, AtlasEntry], path: str = ATLAS_INDEX_PATH):
+    with open(path, 'w', encoding='utf8') as f:
+        json.dump({'version': ATLAS_VERSION, 'titles': {p: asdict(e) for p, e in entries.items()}}, f, indent=1, ensure_ascii=False)
+
+
+def get_grid(count: int, tileSize: Tuple[int, int]) -> Tuple[int, int]:
+    '''Returns the number of columns and rows of tiles to fit on each sheet.'''
+    columns = max(1, min(count, ATLAS_MAX_SIZE // tileSize[0]))
+    return columns, max(1, ATLAS_MAX_SIZE // tileSize[1])
+
+
+def build_atlas_sheets(category: str, titles: List[BakedTitle]) -> Dict[str, AtlasEntry]:
+    '''Packs the titles of one category and size into grid sheets, in manifest order. Identical titles share a tile.
+    Returns the entry of each title.'''
+    tiles: Dict[str, BakedTitle] = {}
+    for t in titles:
+        tiles.setdefault(t.contentHash or t.file, t)
+
+    sizes = []
+    for t in tiles.values():
+        with Image.open(os.path.join(BAKED_PATH, *t.file.split('/'))) as im:
+            sizes.append(im.size)
+    tileSize = (max(w for w, _ in sizes), max(h for _, h in sizes))
+    columns, rows = get_grid(len(tiles), tileSize)
+    perSheet = columns * rows
+
+    placed: Dict[str, AtlasEntry] = {}
+    keys = list(tiles)
+    for n, start in enumerate(range(0, len(keys), perSheet)):
+        sheetKeys = keys[start:start + perSheet]
+        sheetPath = f'{ATLAS_DIRECTORY}/{category}-{n}.png'
+        sheet = Image.new('RGBA', (min(len(sheetKeys), columns) * tileSize[0], -(-len(sheetKeys) // columns) * tileSize[1]))
+        for i, key in enumerate(sheetKeys):
+            with Image.open(os.path.join(BAKED_PATH, *tiles[key].file.split('/'))) as im:
+                x, y = i % columns * tileSize[0], i // columns * tileSize[1]
+                sheet.paste(im.convert('RGBA'), (x, y))
+                placed[key] = AtlasEntry(sheetPath, x, y, im.width, im.height)
+        sheet.save(os.path.join(BAKED_PATH, *sheetPath.split('/')))
+
+    return {t.path: replace(placed[t.contentHash or t.file], inputHash=t.inputHash) for t in titles}
+
+
+def build_atlases(titles: List[BakedTitle]) -> Dict[str, AtlasEntry] | None:
+    '''Packs the baked titles into a set of sheets per honor type and size and writes the coordinate index. Does
+    nothing and returns None if no title has changed since the sheets were last built.'''
+    index = load_index()
+    if index and {p: e.inputHash for p, e in index.items()} == {t.path: t.inputHash for t in titles} and \
+            all(os.path.exists(os.path.join(BAKED_PATH, *s.split('/'))) for s in {e.sheet for e in index.values()}):
+        return None
+
+    Path(ATLAS_PATH).mkdir(parents=True, exist_ok=True)
+    entries: Dict[str, AtlasEntry] = {}
+    categories = groupby(sorted(titles, key=lambda t: (t.honorType, t.size, t.sort_key())), lambda t: f'{t.honorType}-{t.size}')
+    for category, group in track(categories, "Building atlases...", transient=True):
+        entries |= build_atlas_sheets(category, list(group))
+
+    # Remove sheets left over from categories that have shrunk or gone
+    sheets = {os.path.basename(e.sheet) for e in entries.values()}
+    for f in os.listdir(ATLAS_PATH):
+        if f.endswith('.png') and f not in sheets:
+            os.remove(os.path.join(ATLAS_PATH, f))
+
+    save_index(entries)
+    return entries
+
+
+@lru_cache(maxsize=8)
+def load_sheet(sheet: str) -> Image.Image:
+    im = Image.open(os.path.join(BAKED_PATH, *sheet.split('/')))
+    im.load()
+    return im
+
+
+def crop_title(path: str, index: Dict[str, AtlasEntry]) -> Image.Image:
+    '''Cuts a single baked title, given by manifest path, out of its atlas sheet.'''
+    entry = index[path]
+    return load_sheet(entry.sheet).crop(entry.get_box())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog='atlas',
+        description='Builds the baked title atlas sheets and cuts single titles back out of them.'
+    )
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser('build', help='Build the atlas sheets from the baked titles in the manifest.')
+    cropParser = subparsers.add_parser('crop', help='Save single titles cut out of the atlas sheets.')
+    cropParser.add_argument('paths', nargs='+', help='Manifest paths of the titles to crop. Wildcards are allowed, e.g. "character/14-*/main/*".')
+    cropParser.add_argument('-o', '--output', default=os.path.join('output', 'atlas'),
+                            help='Directory to save the titles to, using the same layout as the baked titles.')
+    args = vars(parser.parse_args())
+
+    if args['command'] == 'build':
+        entries = build_atlases(load_manifest())
+        print('Atlases are up to date.' if entries is None else
+              f'Packed {len(entries)} titles into {len({e.sheet for e in entries.values()})} sheets.')
+    else:
+        index = load_index()
+        paths = [p for p in index if any(fnmatch(p, pattern) for pattern in args['paths'])]
+        for p in track(paths, "Cropping titles...", transient=True):
+            outputPath = os.path.join(args['output'], *p.split('/'))
+            Path(outputPath).parent.mkdir(parents=True, exist_ok=True)
+            crop_title(p, index).save(outputPath, lossless=True)  # Only used by webp
+        print(f'Saved {len(paths)} titles to {args["output"]}.')
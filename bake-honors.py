@@ -1,23 +1,31 @@
 import argparse
-import glob
+import hashlib
+import io
+import json
 import os
 import re
-from dataclasses import dataclass
+from contextlib import nullcontext
+from dataclasses import asdict, dataclass, field, replace
+from functools import cache, lru_cache
 from itertools import chain, groupby
+from multiprocessing import Pool
 from pathlib import Path
 import shutil
-from typing import List
+from typing import Dict, Iterable, List, Sequence, Tuple
 
+import numpy as np
 from pathvalidate import sanitize_filename
 from PIL import Image
 from rich.progress import track
 from sqlalchemy import create_engine, select
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import Session, selectinload, sessionmaker
 from git import Repo
 
 import config
+from atlas import build_atlases
 from data import update_data
-from model import Honor, HonorLevel, HonorRarity, HonorType
+from manifest import BAKED_PATH, MANIFEST_PATH, BakedTitle, get_manifest_path, load_manifest, save_manifest
+from model import Honor, HonorGroup, HonorLevel, HonorRarity, HonorType
 
 DEGREE_MAIN_SIZE = (380, 80)
 DEGREE_SUB_SIZE = (180, 80)
@@ -34,193 +42,598 @@ HONOR_FRAME_PATH = os.path.join(config.ASSETS_DIRECTORY, 'honor_frame')
 
 DEGREE_LV_0_PATH = os.path.join(FRAME_PATH, 'icon_degreeLv.png')
 DEGREE_LV_6_PATH = os.path.join(FRAME_PATH, 'icon_degreeLv6.png')
-
-BAKED_PATH = os.path.join(config.ASSETS_DIRECTORY, 'honor_baked')
+DEGREE_STAR_SLOT_PATH = os.path.join(FRAME_PATH, 'icon_degreeStar_Transparent.png')
+DEGREE_STAR_PATH = os.path.join(FRAME_PATH, 'icon_degreeStar.png')
 
 HONOR_REQUIREMENT_PATTERN = re.compile(r'.*?([\d,]+)')
 WORLD_LINK_ASSETBUNDLE_PATTERN = re.compile(r'.*(_cp\d)$')
 
+LAYER_CACHE_SIZE = 256
+# Bump when a change to the renderer changes its output so that every title is baked again
+BAKE_VERSION = 1
+
+
+@lru_cache(maxsize=LAYER_CACHE_SIZE)
+def load_layer(path: str, mode: str | None = None) -> Image.Image:
+    '''Returns a decoded layer image, converted to mode if given. Images are cached per process and shared between
+    titles, so they must not be modified.'''
+    im = Image.open(path)
+    im.load()
+    return im.convert(mode) if mode else im
+
+
+@dataclass(frozen=True)
+class Layer:
+    '''The part of a layer image that changes the title when blended, cropped to its bounding box. Stores the
+    premultiplied pixels (plus the rounding term) and inverse alpha, so blending is one multiply-add per channel, and
+    the result of blending onto a blank canvas, which is just copied in for the bottom layer.'''
+    premultiplied: np.ndarray  # (height, width, 4) uint16
+    inverseAlpha: np.ndarray  # (height, width, 1) uint16
+    blank: np.ndarray  # (height, width, 4) uint16
+    offset: Tuple[int, int]  # Top left of the bounding box within the image
+
+
+def divide_255(values: np.ndarray, out: np.ndarray):
+    '''Rounded division by 255 as done by PIL, for values that already include the rounding term.'''
+    np.right_shift(values, 8, out=out)
+    out += values
+    out >>= 8
+
+
+def to_layer(im: Image.Image, masked: bool = True) -> Layer | None:
+    '''Prepares an image for compositing, or returns None if it is fully transparent. Masked layers are blended as
+    Image.paste(im, pos, im) would. Unmasked layers are blended as if first pasted without a mask onto a blank canvas,
+    which is how the rank image is positioned.'''
+    rgba = im if im.mode == 'RGBA' else im.convert('RGBA')
+    if masked and im.mode not in ('RGBA', 'LA', 'L'):
+        raise ValueError('bad transparency mask')
+    alphaImage = im if masked and im.mode == 'L' else rgba.getchannel('A')
+
+    bbox = alphaImage.getbbox()
+    if bbox is None:
+        return None
+    left, top, right, bottom = bbox
+    # Every intermediate value fits in 16 bits: dst * (255 - a) + src * a + 128 <= 255 * 255 + 128
+    alpha = np.asarray(alphaImage, np.uint16)[top:bottom, left:right, np.newaxis]
+    premultiplied = np.asarray(rgba, np.uint16)[top:bottom, left:right] * alpha + 128
+    blank = np.empty_like(premultiplied)
+    divide_255(premultiplied, blank)
+    return Layer(premultiplied, 255 - alpha, blank, (left, top))
+
+
+@lru_cache(maxsize=LAYER_CACHE_SIZE)
+def get_layer(path: str) -> Layer | None:
+    '''Returns a layer file prepared for compositing. Cached per process like load_layer.'''
+    return to_layer(load_layer(path))
+
+
+def composite(size: Tuple[int, int], layers: Iterable[Tuple[Layer | None, Tuple[int, int]]]) -> Image.Image:
+    '''Blends layers at the given positions onto a blank canvas, bottom to top. Uses the same integer arithmetic as
+    Image.paste with a mask, so the output is identical to pasting each layer in turn, but only the bounding box of
+    each layer is touched and empty layers are skipped.'''
+    width, height = size
+    canvas = np.zeros((height, width, 4), np.uint16)
+    isBlank = True
+    for layer, (x, y) in layers:
+        if layer is None:
+            continue
+        x, y = x + layer.offset[0], y + layer.offset[1]
+        layerHeight, layerWidth = layer.inverseAlpha.shape[:2]
+        left, top, right, bottom = max(x, 0), max(y, 0), min(x + layerWidth, width), min(y + layerHeight, height)
+        if left >= right or top >= bottom:
+            continue
+
+        crop = (slice(top - y, bottom - y), slice(left - x, right - x))
+        area = canvas[top:bottom, left:right]
+        if isBlank:
+            area[...] = layer.blank[crop]
+            isBlank = False
+            continue
+
+        blended = area * layer.inverseAlpha[crop]
+        blended += layer.premultiplied[crop]
+        divide_255(blended, area)
+
+    return Image.fromarray(canvas.astype(np.uint8))
+
+
+@cache
+def hash_file(path: str) -> str:
+    with open(path, 'rb') as f:
+        return hashlib.file_digest(f, 'sha256').hexdigest()
+
+
+@cache
+def get_level_overlay(kind: str, level: int, isSub: bool) -> Image.Image:
+    '''Returns the level pips or FC stars for a level. There are only a handful of distinct overlays, so each is drawn
+    once per process and shared between titles, and must not be modified.'''
+    im = Image.new("RGBA", DEGREE_SUB_SIZE if isSub else DEGREE_MAIN_SIZE)
+
+    if kind == 'stars':
+        if isSub:
+            return im
+
+        slot = load_layer(DEGREE_STAR_SLOT_PATH, "LA")
+        star = load_layer(DEGREE_STAR_PATH)
+
+        for pos in FC_HONOR_LEVEL_STAR_POS:
+            im.paste(slot, pos, slot)
+
+        for pos in FC_HONOR_LEVEL_STAR_POS[:level]:
+            im.paste(star, pos, star)
+    else:
+        lv0Image = load_layer(DEGREE_LV_0_PATH)
+        lv6Image = load_layer(DEGREE_LV_6_PATH)
+
+        for i in range(0, level):
+            im.paste(lv0Image if i < 5 else lv6Image, HONOR_LEVEL_PIP_POS[i])
+
+    return im
+
+
+@cache
+def get_level_layer(kind: str, level: int, isSub: bool) -> Layer | None:
+    return to_layer(get_level_overlay(kind, level, isSub))
+
+
+@dataclass(frozen=True)
+class Encoder:
+    '''How baked titles are saved. Every encoder is lossless.'''
+    format: str
+    extension: str
+    options: Dict[str, object] = field(default_factory=dict)
+    palette: bool = False  # Save images with at most 256 colours as palette images
+
+
+DEFAULT_ENCODER = 'png'
+ENCODERS = {
+    'png': Encoder('PNG', 'png'),
+    'png-optimized': Encoder('PNG', 'png', {'optimize': True, 'compress_level': 9}),
+    'png-palette': Encoder('PNG', 'png', {'optimize': True, 'compress_level': 9}, palette=True),
+    'webp': Encoder('WEBP', 'webp', {'lossless': True, 'quality': 100, 'method': 4}),
+}
+
+
+def to_palette(im: Image.Image) -> Image.Image | None:
+    '''Returns the image as a palette image if it has at most 256 distinct colours, or None if it can't be converted
+    without losing any.'''
+    pixels = np.ascontiguousarray(np.asarray(im.convert('RGBA'))).view(np.uint32)
+    colours, indices = np.unique(pixels, return_inverse=True)
+    if len(colours) > 256:
+        return None
+    palette = Image.frombytes('P', im.size, indices.astype(np.uint8).tobytes())
+    palette.putpalette(colours.view(np.uint8).tobytes(), 'RGBA')
+    return palette
+
+
+def encode_image(im: Image.Image, encoder: Encoder) -> bytes:
+    if encoder.palette:
+        im = to_palette(im) or im
+    with io.BytesIO() as f:
+        im.save(f, encoder.format, **encoder.options)
+        return f.getvalue()
+
+
+def get_encoded_path(path: str, encoder: Encoder) -> str:
+    '''Swaps the extension of a save path for the encoder's. The rest of the naming layout is the same for every encoder.'''
+    return f'{os.path.splitext(path)[0]}.{encoder.extension}'
+
 
 def parse_req(description: str) -> str:
     return HONOR_REQUIREMENT_PATTERN.match(description).group(1).replace(',', '') # type: ignore
 
 
+def is_named_by_requirement(honorType: HonorType, honorCount: int, levelCount: int) -> bool:
+    '''Returns whether titles are saved under their level requirement rather than the honor name.'''
+    return honorType == HonorType.CHARACTER or (honorType == HonorType.ACHIEVEMENT and (honorCount > 1 or levelCount > 1))
+
+
 @dataclass
+class GroupRequirements:
+    '''The parsed requirement of each level in an honor group and the width to pad them to, computed once per group.'''
+    byLevelId: Dict[str, int]
+    padding: int
+
+    @classmethod
+    def from_group(cls, group: HonorGroup) -> 'GroupRequirements | None':
+        '''Returns None for groups that aren't named by requirement.'''
+        if not is_named_by_requirement(HonorType(group.honorType), len(group.honors), max((len(h.levels) for h in group.honors), default=0)):
+            return None
+
+        parsed = {}
+        for l in chain(*[h.levels for h in group.honors]):
+            try:
+                parsed[l.id] = parse_req(l.description)
+            except AttributeError:
+                print(f'Could not parse the requirement of {group.name} level {l.level}: {l.description}')
+        return cls({id: int(r) for id, r in parsed.items()}, max((len(r) for r in parsed.values()), default=0))
+
+
+@dataclass(frozen=True, slots=True)
 class DegreeImage:
-    honor: Honor
-    honorLevel: HonorLevel | None
-    isSub: bool
-
-    def __init__(self, honor: Honor, honorLevel: HonorLevel = None, isSub: bool = False):  # type: ignore
-        self.honor = honor
-        self.honorLevel = honorLevel
-        self.isSub = isSub
+    '''The honor fields needed to render one title, copied out of the DB so it can be sent to worker processes.'''
+    honorType: HonorType
+    groupId: int
+    groupName: str
+    groupBackground: str | None
+    groupFrameName: str | None
+    groupHonorCount: int
+    honorName: str
+    honorAssetbundleName: str | None
+    honorRarity: str | None
+    honorMissionType: str | None
+    honorLevelCount: int
+    level: int | None = None
+    levelAssetbundleName: str | None = None
+    levelRarity: str | None = None
+    requirement: int | None = None  # Only set for titles named after their requirement
+    requirementPadding: int = 0
+    isSub: bool = False
+
+    @classmethod
+    def from_honor(cls, honor: Honor, honorLevel: HonorLevel | None = None, isSub: bool = False,
+                   requirements: 'GroupRequirements | None' = None) -> 'DegreeImage':
+        return cls(
+            honorType=HonorType(honor.group.honorType),
+            groupId=honor.group.id,
+            groupName=honor.group.name,
+            groupBackground=honor.group.backgroundAssetbundleName,
+            groupFrameName=honor.group.frameName,
+            groupHonorCount=len(honor.group.honors),
+            honorName=honor.name,
+            honorAssetbundleName=honor.assetbundleName,
+            honorRarity=honor.honorRarity,  # type: ignore
+            honorMissionType=honor.honorMissionType,  # type: ignore
+            honorLevelCount=len(honor.levels),
+            level=honorLevel.level if honorLevel else None,
+            levelAssetbundleName=honorLevel.assetbundleName if honorLevel else None,
+            levelRarity=honorLevel.honorRarity if honorLevel else None,  # type: ignore
+            requirement=requirements.byLevelId.get(honorLevel.id) if requirements and honorLevel else None,
+            requirementPadding=requirements.padding if requirements else 0,
+            isSub=isSub
+        )
 
     def is_world_link(self) -> bool:
-        assetbundleName: str = i.honorLevel.assetbundleName if i.honorLevel and i.honorLevel.assetbundleName else i.honor.assetbundleName  # type: ignore
+        assetbundleName: str = self.levelAssetbundleName or self.honorAssetbundleName  # type: ignore
         return WORLD_LINK_ASSETBUNDLE_PATTERN.match(assetbundleName) is not None
 
-    def get_bg_image(self) -> Image.Image:
-        '''Returns the degree background image.'''
-        if HonorType(self.honor.group.honorType) == HonorType.RANK_MATCH:
+    def get_bg_path(self) -> str | None:
+        '''Returns the path of the degree background image, or None if there isn't one.'''
+        if self.honorType == HonorType.RANK_MATCH:
             path = os.path.join(
-                RANK_LIVE_PATH, self.honor.group.backgroundAssetbundleName)  # type: ignore
-        elif self.honor.group.backgroundAssetbundleName:
+                RANK_LIVE_PATH, self.groupBackground)  # type: ignore
+        elif self.groupBackground:
             path = os.path.join(
-                HONOR_PATH, self.honor.group.backgroundAssetbundleName)
-        elif self.honorLevel and self.honorLevel.assetbundleName:
-            path = os.path.join(HONOR_PATH, self.honorLevel.assetbundleName)
-        elif self.honor.assetbundleName:
-            path = os.path.join(HONOR_PATH, self.honor.assetbundleName)
+                HONOR_PATH, self.groupBackground)
+        elif self.levelAssetbundleName:
+            path = os.path.join(HONOR_PATH, self.levelAssetbundleName)
+        elif self.honorAssetbundleName:
+            path = os.path.join(HONOR_PATH, self.honorAssetbundleName)
         else:
             path = ""
 
         if not os.path.exists(path):
-            return Image.new("RGBA", DEGREE_SUB_SIZE if self.isSub else DEGREE_MAIN_SIZE)
-        return Image.open(os.path.join(path, 'degree_sub.webp' if self.isSub else 'degree_main.webp'))
+            return None
+        return os.path.join(path, 'degree_sub.webp' if self.isSub else 'degree_main.webp')
 
-    def get_frame_image(self) -> Image.Image:
-        '''Returns the degree frame image.'''
-        rarity = HonorRarity(self.honorLevel.honorRarity) if self.honorLevel and self.honorLevel.honorRarity else HonorRarity(
-            self.honor.honorRarity)
+    def get_frame_path(self) -> str:
+        rarity = HonorRarity(self.levelRarity or self.honorRarity)
         rarityLv = [HonorRarity.LOW, HonorRarity.MIDDLE,
                     HonorRarity.HIGH, HonorRarity.HIGHEST].index(rarity)+1
         filename = f'frame_degree_{"s" if self.isSub else "m"}_{rarityLv}.png'
 
-        if rarityLv > 2 and self.honor.group.frameName:
+        if rarityLv > 2 and self.groupFrameName:
             path = os.path.join(
-                HONOR_FRAME_PATH, self.honor.group.frameName, filename)
+                HONOR_FRAME_PATH, self.groupFrameName, filename)
         else:
             path = os.path.join(FRAME_PATH, filename)
 
-        return Image.open(path)
-
-    def get_rank_image(self) -> Image.Image | None:
-        '''Returns the degree rank image.'''
-        im = Image.new(
-            "RGBA", DEGREE_SUB_SIZE if self.isSub else DEGREE_MAIN_SIZE)
+        return path
 
-        if HonorType(self.honor.group.honorType) == HonorType.EVENT:
-            path = os.path.join(HONOR_PATH, self.honor.assetbundleName,  # type: ignore
+    def get_rank_path(self) -> str | None:
+        '''Returns the path of the degree rank image, or None if there isn't one.'''
+        if self.honorType == HonorType.EVENT:
+            path = os.path.join(HONOR_PATH, self.honorAssetbundleName,  # type: ignore
                                 'rank_sub.webp' if self.isSub else 'rank_main.webp')  # type: ignore
-        elif HonorType(self.honor.group.honorType) == HonorType.RANK_MATCH:
-            path = os.path.join(RANK_LIVE_PATH, os.path.join(*self.honor.assetbundleName.split('/')), # type: ignore
+        elif self.honorType == HonorType.RANK_MATCH:
+            path = os.path.join(RANK_LIVE_PATH, os.path.join(*self.honorAssetbundleName.split('/')), # type: ignore
                                 'sub.webp' if self.isSub else 'main.webp')
-        elif self.honor.honorMissionType:
+        elif self.honorMissionType:
             path = os.path.join(
-                HONOR_PATH, self.honorLevel.assetbundleName, 'scroll.webp') # type: ignore
+                HONOR_PATH, self.levelAssetbundleName, 'scroll.webp') # type: ignore
         else:
-            return im
+            return None
 
-        if not os.path.exists(path):
-            return im
+        return path if os.path.exists(path) else None
 
-        rankImage = Image.open(path)
+    def get_rank_position(self, rankImage: Image.Image) -> Tuple[int, int]:
+        '''Returns where the rank image goes on the title.'''
+        width = (DEGREE_SUB_SIZE if self.isSub else DEGREE_MAIN_SIZE)[0]
         if self.is_world_link():
-            pos = (0, 0)
-        elif self.honor.honorMissionType:
-            pos = ((im.width-rankImage.width)//2,
-                   0) if self.isSub else (220, 0)
+            return (0, 0)
+        elif self.honorMissionType:
+            return ((width-rankImage.width)//2, 0) if self.isSub else (220, 0)
         elif self.isSub:
-            pos = ((im.width-rankImage.width)//2, 40)
+            return ((width-rankImage.width)//2, 40)
         else:
-            pos = (200, 0)
-
-        im.paste(rankImage, pos)
-        return im
-
-    def get_level_stars(self) -> Image.Image:
-        '''Returns the degree level stars. Used for full combo achievement honors.'''
-        im = Image.new(
-            "RGBA", DEGREE_SUB_SIZE if self.isSub else DEGREE_MAIN_SIZE)
-        if self.isSub:
-            return im
-
-        slot = Image.open(os.path.join(
-            FRAME_PATH, 'icon_degreeStar_Transparent.png')).convert("LA")
-        star = Image.open(os.path.join(FRAME_PATH, 'icon_degreeStar.png'))
+            return (200, 0)
 
-        for pos in FC_HONOR_LEVEL_STAR_POS:
-            im.paste(slot, pos, slot)
-
-        for pos in FC_HONOR_LEVEL_STAR_POS[:((self.honorLevel.level-1) % 10)+1]: # type: ignore
-            im.paste(star, pos, star)
-
-        return im
-
-    def get_level_pips(self) -> Image.Image:
-        '''Returns the degree level pips image.'''
-        im = Image.new(
-            "RGBA", DEGREE_SUB_SIZE if self.isSub else DEGREE_MAIN_SIZE)
-
-        lv0Image = Image.open(DEGREE_LV_0_PATH)
-        lv6Image = Image.open(DEGREE_LV_6_PATH)
-
-        for i in range(0, self.honorLevel.level): # type: ignore
-            im.paste(lv0Image if i < 5 else lv6Image, HONOR_LEVEL_PIP_POS[i])
-
-        return im
+    def get_rank_layer(self) -> Tuple[Layer | None, Tuple[int, int]]:
+        path = self.get_rank_path()
+        if path is None:
+            return None, (0, 0)
+        rankImage = Image.open(path)
+        return to_layer(rankImage, masked=False), self.get_rank_position(rankImage)
+
+    def has_level_pips(self) -> bool:
+        return self.honorType == HonorType.CHARACTER or (self.honorType == HonorType.ACHIEVEMENT and self.honorLevelCount > 1)
+
+    def get_level_layer(self) -> Layer | None:
+        if self.honorMissionType:
+            return get_level_layer('stars', ((self.level-1) % 10)+1, self.isSub)  # type: ignore
+        if self.has_level_pips():
+            return get_level_layer('pips', self.level, self.isSub)  # type: ignore
+        return None
+
+    def get_input_paths(self) -> List[str]:
+        '''Returns the paths of every layer file used to render this image.'''
+        if self.honorMissionType:
+            levelPaths = [] if self.isSub else [DEGREE_STAR_SLOT_PATH, DEGREE_STAR_PATH]
+        elif self.has_level_pips():
+            levelPaths = [DEGREE_LV_0_PATH, DEGREE_LV_6_PATH]
+        else:
+            levelPaths = []
+        return [p for p in [self.get_bg_path(), self.get_frame_path(), self.get_rank_path(), *levelPaths] if p]
 
-    def get_level_image(self) -> Image.Image:
-        '''Returns the degree level pips image.'''
-        if self.honor.honorMissionType:
-            return self.get_level_stars()
-        if HonorType(self.honor.group.honorType) == HonorType.CHARACTER or (HonorType(self.honor.group.honorType) == HonorType.ACHIEVEMENT and len(self.honor.levels) > 1):
-            return self.get_level_pips()
-        return Image.new("RGBA", DEGREE_SUB_SIZE if self.isSub else DEGREE_MAIN_SIZE)
+    def get_input_hash(self, encoder: str = DEFAULT_ENCODER) -> str:
+        '''Returns a hash of everything that affects the saved image: the renderer version, the encoder, the honor
+        fields and the contents of each layer file.'''
+        h = hashlib.sha256(json.dumps([BAKE_VERSION, encoder, asdict(self)], default=str).encode('utf8'))
+        for path in self.get_input_paths():
+            h.update(f'|{path}|{hash_file(path)}'.encode('utf8'))
+        return h.hexdigest()
 
     def get_degree_image(self) -> Image.Image:
         '''Returns the complete degree image.'''
-        layers = [
-            self.get_bg_image(),
-            self.get_frame_image(),
-            self.get_rank_image(),
-            self.get_level_image()
-        ]
-
-        im = Image.new(
-            "RGBA", DEGREE_SUB_SIZE if self.isSub else DEGREE_MAIN_SIZE)
-
-        for l in layers:
-            im.paste(l, (0, 0), l)
-
-        return im
+        bgPath = self.get_bg_path()
+        return composite(DEGREE_SUB_SIZE if self.isSub else DEGREE_MAIN_SIZE, [
+            (get_layer(bgPath) if bgPath else None, (0, 0)),
+            (get_layer(self.get_frame_path()), (0, 0)),
+            self.get_rank_layer(),
+            (self.get_level_layer(), (0, 0))
+        ])
+
+    def get_baked_title(self, path: str) -> BakedTitle:
+        '''Returns the manifest entry for this image saved at the given path.'''
+        return BakedTitle(
+            path=get_manifest_path(path),
+            honorType=self.honorType.value,
+            groupId=self.groupId,
+            size='sub' if self.isSub else 'main',
+            level=self.level,
+            requirement=self.requirement
+        )
 
     def get_save_path(self) -> str:
-        match HonorType(self.honor.group.honorType):
+        if is_named_by_requirement(self.honorType, self.groupHonorCount, self.honorLevelCount) and self.requirement is None:
+            raise ValueError(f'Could not find the requirement of {self.groupName} level {self.level}')
+
+        match self.honorType:
             case HonorType.CHARACTER:
-                charLevel = parse_req(self.honorLevel.description) # type: ignore
                 return os.path.join(
                     BAKED_PATH,
-                    i.honor.group.honorType, # type: ignore
+                    self.honorType.value,
                     sanitize_filename(
-                        f'{i.honor.group.id:02d}-{i.honor.group.name}'), # type: ignore
+                        f'{self.groupId:02d}-{self.groupName}'),
                     'sub' if self.isSub else 'main',
-                    f'CR{int(charLevel):03d}.png'
+                    f'CR{self.requirement:03d}.png'
                 ).replace(' ', '-') # type: ignore
-            case HonorType.ACHIEVEMENT if len(self.honor.levels) > 1 or len(self.honor.group.honors) > 1:
-                req = parse_req(self.honorLevel.description) # type: ignore
-                levels = chain(*[h.levels for h in self.honor.group.honors])
-                padding = max(len(parse_req(l.description)) for l in levels)
+            case HonorType.ACHIEVEMENT if self.honorLevelCount > 1 or self.groupHonorCount > 1:
                 return os.path.join(
                     BAKED_PATH,
-                    i.honor.group.honorType, # type: ignore
+                    self.honorType.value,
                     sanitize_filename(
-                        f'{i.honor.group.id:04d}-{i.honor.group.name}'), # type: ignore
+                        f'{self.groupId:04d}-{self.groupName}'),
                     'sub' if self.isSub else 'main',
-                    '{1:0{0}}.png'.format(padding, int(req))
+                    '{1:0{0}}.png'.format(self.requirementPadding, self.requirement)
                 ).replace(' ', '-') # type: ignore
             case _:
                 return os.path.join(
                     BAKED_PATH,
-                    i.honor.group.honorType, # type: ignore
+                    self.honorType.value,
                     sanitize_filename(
-                        f'{i.honor.group.id:04d}-{i.honor.group.name}'), # type: ignore
+                        f'{self.groupId:04d}-{self.groupName}'),
                     'sub' if self.isSub else 'main',
-                    sanitize_filename(f'{self.honor.name}.png')
+                    sanitize_filename(f'{self.honorName}.png')
                 ).replace(' ', '-') # type: ignore
 
 
+def load_honor_groups(session: Session) -> Sequence[HonorGroup]:
+    '''Loads every honor group along with its honors and their levels in three queries, rather than one per honor and
+    level as they are touched.'''
+    return session.execute(
+        select(HonorGroup)
+        .options(selectinload(HonorGroup.honors).selectinload(Honor.levels))
+        .order_by(HonorGroup.id)
+    ).scalars().all()
+
+
+def get_degree_images(groups: Iterable[HonorGroup]) -> Tuple[List[DegreeImage], List[DegreeImage]]:
+    '''Returns the main and sub size render spec of every title in the honor groups.'''
+    mainImages: List[DegreeImage] = []
+    subImages: List[DegreeImage] = []
+    for g in groups:
+        requirements = GroupRequirements.from_group(g)
+        for h in sorted(g.honors, key=lambda h: h.id):
+            if not h.levels:
+                mainImages.append(DegreeImage.from_honor(h))
+                subImages.append(DegreeImage.from_honor(h, isSub=True))
+                continue
+
+            for l in h.levels:
+                mainImages.append(DegreeImage.from_honor(h, l, requirements=requirements))
+                subImages.append(DegreeImage.from_honor(h, l, True, requirements))
+    return mainImages, subImages
+
+
+@dataclass
+class BakeJob:
+    image: DegreeImage
+    path: str  # Manifest path to save the image to
+    encoder: str = DEFAULT_ENCODER
+    greyPath: str | None = None  # Where to save a greyed out copy of the image, if it is the source of one
+    reportSavings: bool = False  # Also encode with the default encoder to compare sizes
+
+
+@dataclass
+class BakeResult:
+    title: BakedTitle | None
+    greyPath: str | None
+    error: str | None
+    cacheHits: int
+    cacheMisses: int
+    size: int = 0  # Bytes written, including the greyed out copy
+    defaultSize: int = 0  # Bytes the same images take with the default encoder, if they were measured
+    contentHashes: List[str] = field(default_factory=list)  # Of the title and then its greyed out copy
+
+
+def bake_image(job: BakeJob) -> BakeResult:
+    '''Renders, encodes and saves a title, and its greyed out copy if it has one. Returns its manifest entry or the
+    error if it failed, along with the layer cache hits and misses it caused and the size of the files.'''
+    before = get_layer.cache_info()
+    encoder = ENCODERS[job.encoder]
+    size = defaultSize = 0
+    contentHashes = []
+    try:
+        path = os.path.join(BAKED_PATH, *job.path.split('/'))
+        Path(*path.split(os.sep)[:-1]).mkdir(parents=True, exist_ok=True)
+        im = job.image.get_degree_image()
+        outputs = [(path, im)]
+        if job.greyPath:
+            outputs.append((os.path.join(BAKED_PATH, *job.greyPath.split('/')), im.convert('LA')))
+
+        for outputPath, image in outputs:
+            data = encode_image(image, encoder)
+            write_atomic(outputPath, data)
+            contentHashes.append(hashlib.sha256(data).hexdigest())
+            size += len(data)
+            if job.encoder == DEFAULT_ENCODER:
+                defaultSize += len(data)
+            elif job.reportSavings:
+                defaultSize += len(encode_image(image, ENCODERS[DEFAULT_ENCODER]))
+        title, error = job.image.get_baked_title(path), None
+    except Exception as e:
+        title, error = None, str(e)
+
+    after = get_layer.cache_info()
+    return BakeResult(title, job.greyPath if title else None, error, after.hits - before.hits, after.misses - before.misses,
+                      size, defaultSize, contentHashes)
+
+
+def get_grey_paths(images: Dict[str, DegreeImage], extension: str = 'png') -> Dict[str, str]:
+    '''Picks the title each greyed out "unearned" title is made from: CR5 for character titles and the lowest
+    requirement in each achievement directory. Returns the grey title path for each source, by manifest path.'''
+    greyPaths: Dict[str, str] = {}
+    directories = set()
+    for path, image in sorted(images.items(), key=lambda i: (i[1].requirement is None, i[1].requirement or 0, i[0])):
+        directory = path.rsplit('/', 1)[0]
+        if image.honorType == HonorType.CHARACTER and image.requirement == 5:
+            greyPaths[path] = f'{directory}/CR000.{extension}'
+        elif image.honorType == HonorType.ACHIEVEMENT and directory not in directories and path != f'{directory}/0000.{extension}':
+            greyPaths[path] = f'{directory}/0000.{extension}'
+            directories.add(directory)
+    return greyPaths
+
+
+def get_grey_hash(sourcePath: str, sourceInputHash: str) -> str:
+    return hashlib.sha256(f'grey|{sourcePath}|{sourceInputHash}'.encode('utf8')).hexdigest()
+
+
+def get_grey_title(source: BakedTitle, path: str, contentHash: str) -> BakedTitle:
+    '''Returns the manifest entry of a greyed out title, hashed from the title it was made from.'''
+    return replace(source, path=path, level=0, requirement=0, inputHash=get_grey_hash(source.path, source.inputHash),  # type: ignore
+                   contentHash=contentHash, aliasOf=None)
+
+
+def write_atomic(path: str, data: bytes):
+    '''Writes a file through a temp file, so an interrupted bake never leaves a partial image. This also replaces
+    hardlinks rather than writing through them.'''
+    tempPath = f'{path}.tmp'
+    with open(tempPath, 'wb') as f:
+        f.write(data)
+    os.replace(tempPath, path)
+
+
+def link_atomic(source: str, path: str, hardlink: bool = True):
+    '''Replaces a file with a hardlink to source, or a copy of it if hardlink is False or links aren't supported.'''
+    tempPath = f'{path}.tmp'
+    if os.path.exists(tempPath):
+        os.remove(tempPath)
+    if hardlink:
+        try:
+            os.link(source, tempPath)
+        except OSError:
+            hardlink = False
+    if not hardlink:
+        shutil.copyfile(source, tempPath)
+    os.replace(tempPath, path)
+
+
+DEDUPE_MODES = ['none', 'link', 'alias']
+
+
+def dedupe_titles(titles: List[BakedTitle], mode: str) -> Tuple[List[BakedTitle], int, int]:
+    '''Stores each distinct image once. The first title in path order with a given content hash keeps its file and
+    the others become hardlinks to it ('link') or aliases of it in the manifest without a file of their own ('alias').
+    With 'none' every title has its own copy. Returns the updated titles, the number of distinct images and the bytes
+    saved.'''
+    deduped: List[BakedTitle] = []
+    distinct = saved = 0
+    for _, group in groupby(sorted(titles, key=lambda t: (t.contentHash, t.path)), lambda t: t.contentHash):
+        group = list(group)
+        canonical, *duplicates = group
+        canonicalPath = os.path.join(BAKED_PATH, *canonical.path.split('/'))
+        if canonical.aliasOf:
+            link_atomic(os.path.join(BAKED_PATH, *canonical.aliasOf.split('/')), canonicalPath, mode == 'link')
+            canonical = replace(canonical, aliasOf=None)
+        deduped.append(canonical)
+        distinct += 1
+
+        for t in duplicates:
+            path = os.path.join(BAKED_PATH, *t.path.split('/'))
+            if mode == 'alias':
+                if os.path.exists(path):
+                    os.remove(path)
+                deduped.append(replace(t, aliasOf=canonical.path))
+                continue
+
+            if not os.path.exists(path) or mode == 'link' and not os.path.samefile(path, canonicalPath):
+                link_atomic(canonicalPath, path, mode == 'link')
+            deduped.append(replace(t, aliasOf=None))
+        if mode != 'none':
+            saved += os.path.getsize(canonicalPath) * len(duplicates)
+
+    return deduped, distinct, saved
+
+
+def remove_files(paths: Iterable[str]):
+    '''Deletes baked files given by manifest path, along with any directories left empty.'''
+    for path in paths:
+        fullPath = os.path.join(BAKED_PATH, *path.split('/'))
+        if not os.path.exists(fullPath):
+            continue
+        os.remove(fullPath)
+        directory = os.path.dirname(fullPath)
+        while directory != BAKED_PATH and not os.listdir(directory):
+            os.rmdir(directory)
+            directory = os.path.dirname(directory)
+
+
+def get_chunksize(count: int, workers: int) -> int:
+    '''Sends work to the pool in chunks small enough to keep the progress bar moving and the workers evenly loaded.'''
+    return max(1, min(32, count // (workers * 8)))
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
         prog='bake-honors',
@@ -228,6 +641,18 @@ if __name__ == "__main__":
     )
     parser.add_argument('-nu', '--no-update', action='store_true',
                         help='Skip updating the DB. Use this if you have already pulled the DB.')
+    parser.add_argument('-j', '--jobs', type=int, default=config.BAKE_MAX_WORKERS,
+                        help='Number of worker processes to render images with. Defaults to BAKE_MAX_WORKERS in the config, or the number of CPU cores if that is not set.')
+    parser.add_argument('-f', '--force', action='store_true',
+                        help='Bake every title again, even if nothing has changed since the last bake.')
+    parser.add_argument('-e', '--encoder', choices=ENCODERS, default=DEFAULT_ENCODER,
+                        help='How to save the baked images. png-optimized compresses harder, png-palette also stores images with at most 256 colours as palette images, and webp saves lossless WebP files instead. Defaults to png.')
+    parser.add_argument('--report-savings', action='store_true',
+                        help='Also encode every baked image as a default PNG to report the bytes the encoder saves. This makes the bake slower.')
+    parser.add_argument('-d', '--dedupe', choices=DEDUPE_MODES, default='link',
+                        help='How to store titles that are identical to another: link saves them as hardlinks to one file, alias lists them in the manifest as aliases of the other title without a file of their own, and none saves a copy for each. Defaults to link.')
+    parser.add_argument('--atlas', action='store_true',
+                        help='Also pack the baked titles into atlas sheets with a JSON index of where each title is. See atlas.py.')
     args = vars(parser.parse_args())
 
     # Get latest data
@@ -237,58 +662,102 @@ if __name__ == "__main__":
     # DB Setup
     engine = create_engine(config.DATABASE_STRING)
     Session = sessionmaker(bind=engine)
-    session = Session()
 
-    # Get Honors
-    honors = session.execute(select(Honor)).scalars().all()
-
-    # Generate Images
-    shutil.rmtree(BAKED_PATH)
-
-    mainImages: List[DegreeImage] = []
-    subImages: List[DegreeImage] = []
-    for h in track(honors, "Getting degrees...", transient=True):
-        if not h.levels:
-            mainImages.append(DegreeImage(h))
-            subImages.append(DegreeImage(h, isSub=True))
-            continue
-
-        for l in h.levels:
-            mainImages.append(DegreeImage(h, l))
-            subImages.append(DegreeImage(h, l, True))
-
-    for i in track(mainImages, "Generating main images...", transient=True):
+    # Load the previous bake. Without a manifest there's no way to tell what is stale, so start from scratch.
+    previous: Dict[str, BakedTitle] = {}
+    if os.path.exists(MANIFEST_PATH):
+        previous = {t.path: t for t in load_manifest()}
+    elif os.path.exists(BAKED_PATH):
+        shutil.rmtree(BAKED_PATH)
+
+    # Get the honors, then render from plain specs without touching the DB again
+    with Session() as session:
+        mainImages, subImages = get_degree_images(track(load_honor_groups(session), "Getting degrees...", transient=True))
+
+    # Only render images whose inputs have changed since the last bake
+    encoder = ENCODERS[args['encoder']]
+    images: Dict[str, DegreeImage] = {}
+    inputHashes: Dict[str, str] = {}
+    for i in track([*mainImages, *subImages], "Checking for changes...", transient=True):
         try:
-            path = i.get_save_path()
-            Path(*path.split(os.sep)[:-1]).mkdir(parents=True, exist_ok=True)
-            with open(path, 'wb') as f:
-                i.get_degree_image().save(f)
+            path = get_manifest_path(get_encoded_path(i.get_save_path(), encoder))
+            inputHashes[path] = i.get_input_hash(args['encoder'])
         except Exception as e:
             print(e)
-
-    for i in track(subImages, "Generating sub images...", transient=True):
-        try:
-            path = i.get_save_path()
-            Path(*path.split(os.sep)[:-1]).mkdir(parents=True, exist_ok=True)
-            with open(path, 'wb') as f:
-                i.get_degree_image().save(f)
-        except Exception as e:
-            print(e)
-
-    # Generate greyed out CR0 Titles
-    for i in track(glob.glob('**/CR005.png', root_dir=os.path.join(BAKED_PATH, 'character'), recursive=True), "Generating CR0 images...", transient=True):
-        im = Image.open(os.path.join(BAKED_PATH, 'character', i)).convert('LA')
-        im.save(os.path.join(BAKED_PATH, 'character',
-                *i.split(os.sep)[:-1], 'CR000.png'))
-
-    # Generate greyed out level 0 titles
-    achievements = glob.glob(
-        '**/*.png', root_dir=os.path.join(BAKED_PATH, 'achievement'), recursive=True)
-    for k, g in track(groupby(achievements, lambda p: p.split(os.sep)[0:2]), "Generating LV0 images...", transient=True):
-        i = next(g)
-        if i.endswith(os.sep + '0000.png'):
-            i = next(g)
-        im = Image.open(os.path.join(
-            BAKED_PATH, 'achievement', i)).convert('LA')
-        im.save(os.path.join(BAKED_PATH, 'achievement',
-                *i.split(os.sep)[:-1], '0000.png'))
+            continue
+        images[path] = i
+
+    greyPaths = get_grey_paths(images, encoder.extension)
+    expectedHashes = inputHashes | {grey: get_grey_hash(source, inputHashes[source]) for source, grey in greyPaths.items()}
+
+    def is_unchanged(path: str) -> bool:
+        '''Whether the previous bake of a title can be kept: its inputs are the same and its file, or the title it is an
+        alias of, is still there and unchanged.'''
+        old = previous.get(path)
+        if old is None or old.inputHash != expectedHashes[path]:
+            return False
+        if old.aliasOf:
+            return old.aliasOf in expectedHashes and is_unchanged(old.aliasOf)
+        return os.path.exists(os.path.join(BAKED_PATH, *old.path.split('/')))
+
+    titles: List[BakedTitle] = []
+    pendingMain: List[BakeJob] = []
+    pendingSub: List[BakeJob] = []
+    for path, i in images.items():
+        greyPath = greyPaths.get(path)
+        if not args.get('force') and is_unchanged(path) and (not greyPath or is_unchanged(greyPath)):
+            titles.append(previous[path])
+            if greyPath:
+                titles.append(previous[greyPath])
+        else:
+            (pendingSub if i.isSub else pendingMain).append(BakeJob(i, path, args['encoder'], greyPath, args['report_savings']))
+    print(f'{len(pendingMain) + len(pendingSub)} of {len(mainImages) + len(subImages)} titles need baking.')
+
+    # Remove titles that no longer exist
+    remove_files(t.path for t in previous.values() if t.path not in inputHashes and t.path not in greyPaths.values())
+
+    cacheHits = cacheMisses = 0
+    sizes: Dict[str, List[int]] = {}  # Category: [files, bytes, bytes with the default encoder]
+    jobs = args['jobs'] or os.cpu_count() or 1
+    with Pool(jobs) if jobs > 1 and pendingMain + pendingSub else nullcontext() as pool:
+        for pending, description in [(pendingMain, "Generating main images..."), (pendingSub, "Generating sub images...")]:
+            results = pool.imap_unordered(bake_image, pending, get_chunksize(len(pending), jobs)) if pool else map(bake_image, pending)
+            for result in track(results, description, total=len(pending), transient=True):
+                cacheHits += result.cacheHits
+                cacheMisses += result.cacheMisses
+                if result.error:
+                    print(result.error)
+                    continue
+                title = replace(result.title, inputHash=inputHashes[result.title.path], contentHash=result.contentHashes[0])  # type: ignore
+                titles.append(title)
+                if result.greyPath:
+                    titles.append(get_grey_title(title, result.greyPath, result.contentHashes[1]))
+
+                categorySizes = sizes.setdefault(title.honorType, [0, 0, 0])
+                categorySizes[0] += 2 if result.greyPath else 1
+                categorySizes[1] += result.size
+                categorySizes[2] += result.defaultSize
+
+    # Store identical images once. Titles kept from bakes before content hashes were recorded are hashed from their file.
+    titles = [t if t.contentHash else replace(t, contentHash=hash_file(os.path.join(BAKED_PATH, *t.file.split('/')))) for t in titles]
+    titles, distinct, dedupeSaved = dedupe_titles(titles, args['dedupe'])
+    print(f'{len(titles)} titles, {distinct} distinct images ({len(titles) / max(distinct, 1):.2f}x)' +
+          (f', {dedupeSaved:,} bytes saved by {"hardlinks" if args["dedupe"] == "link" else "aliases"}.' if args['dedupe'] != 'none' else '.'))
+
+    remove_files(t.path for t in previous.values() if t.path not in {t.file for t in titles})
+    save_manifest(titles)
+    if args.get('atlas'):
+        atlasEntries = build_atlases(titles)
+        if atlasEntries is not None:
+            print(f'Packed {len(atlasEntries)} titles into {len({e.sheet for e in atlasEntries.values()})} atlas sheets.')
+    print(f'Layer cache: {cacheHits} hits, {cacheMisses} misses')
+
+    if sizes and (args['report_savings'] or args['encoder'] == DEFAULT_ENCODER):
+        print(f'{"Category":<14}{"Files":>7}{"PNG bytes":>14}{args["encoder"] + " bytes":>20}{"Saved":>14}')
+        for category, (files, size, defaultSize) in sorted(sizes.items()):
+            saved = defaultSize - size
+            print(f'{category:<14}{files:>7}{defaultSize:>14,}{size:>20,}{saved:>14,} ({saved / defaultSize:.1%})')
+    elif sizes:
+        print(f'{"Category":<14}{"Files":>7}{args["encoder"] + " bytes":>20}')
+        for category, (files, size, _) in sorted(sizes.items()):
+            print(f'{category:<14}{files:>7}{size:>20,}')
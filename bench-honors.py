@@ -0,0 +1,257 @@
+import argparse
+import importlib.util
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+from contextlib import nullcontext
+from pathlib import Path
+from time import perf_counter
+from typing import Dict, List, Tuple
+
+from PIL import Image, ImageDraw
+from rich.progress import track
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session, sessionmaker
+
+import config
+from manifest import MANIFEST_PATH
+from model import Base, Honor, HonorGroup, HonorLevel, HonorMissionType, HonorRarity, HonorType
+from perf import format_bytes, peak_rss
+
+BAKE_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bake-honors.py')
+RARITIES = [HonorRarity.LOW, HonorRarity.MIDDLE, HonorRarity.HIGH, HonorRarity.HIGHEST]
+STAGES = ['background', 'frame', 'rank', 'level', 'composite', 'encode']
+
+
+def load_bake_module():
+    '''Imports bake-honors.py, which can't be imported normally because of the dash in its name.'''
+    spec = importlib.util.spec_from_file_location('bake_honors', BAKE_SCRIPT)
+    module = importlib.util.module_from_spec(spec)  # type: ignore
+    spec.loader.exec_module(module)  # type: ignore
+    return module
+
+
+def save_placeholder(path: str, size: Tuple[int, int], rng: random.Random, background: bool = True):
+    '''Saves a placeholder layer: a gradient with a few translucent shapes, or just the shapes if not a background.'''
+    im = Image.new('RGBA', size)
+    draw = ImageDraw.Draw(im)
+    if background:
+        start, end = [rng.randrange(256) for _ in range(3)], [rng.randrange(256) for _ in range(3)]
+        for x in range(0, size[0], 4):
+            draw.rectangle((x, 0, x + 3, size[1]), fill=(*[s + (e - s) * x // size[0] for s, e in zip(start, end)], 255))
+    for _ in range(6):
+        x, y = rng.randrange(size[0]), rng.randrange(size[1])
+        draw.ellipse((x, y, x + rng.randint(4, size[0] // 3), y + rng.randint(4, size[1] // 2)),
+                     fill=(rng.randrange(256), rng.randrange(256), rng.randrange(256), rng.randint(96, 255)))
+
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    im.save(path)
+
+
+def create_frame_assets(bake, rng: random.Random):
+    '''Saves the frames and level icons that every title is built from.'''
+    for size, letter in [(bake.DEGREE_MAIN_SIZE, 'm'), (bake.DEGREE_SUB_SIZE, 's')]:
+        for rarityLv in range(1, 5):
+            save_placeholder(os.path.join(bake.FRAME_PATH, f'frame_degree_{letter}_{rarityLv}.png'), size, rng, False)
+            if rarityLv > 2:
+                save_placeholder(os.path.join(bake.HONOR_FRAME_PATH, 'bench', f'frame_degree_{letter}_{rarityLv}.png'), size, rng, False)
+
+    for path, size in [(bake.DEGREE_LV_0_PATH, (14, 14)), (bake.DEGREE_LV_6_PATH, (14, 14)),
+                       (bake.DEGREE_STAR_SLOT_PATH, (16, 16)), (bake.DEGREE_STAR_PATH, (16, 16))]:
+        save_placeholder(path, size, rng)
+
+
+def create_degree_assets(bake, directory: str, rng: random.Random):
+    save_placeholder(os.path.join(directory, 'degree_main.webp'), bake.DEGREE_MAIN_SIZE, rng)
+    save_placeholder(os.path.join(directory, 'degree_sub.webp'), bake.DEGREE_SUB_SIZE, rng)
+
+
+def create_benchmark_data(bake, session: Session, scale: int):
+    '''Fills an empty database with honors of every type, roughly scale times the real number of titles, and saves
+    their layers where get-honor-images.py would download them.'''
+    rng = random.Random(0)
+    create_frame_assets(bake, rng)
+    groupId = honorId = levelId = 0
+
+    def add_group(name: str, honorType: HonorType, background: str | None = None) -> int:
+        nonlocal groupId
+        groupId += 1
+        session.add(HonorGroup(id=groupId, name=name, honorType=honorType.value, backgroundAssetbundleName=background,
+                               frameName='bench' if groupId % 4 == 0 else None))
+        return groupId
+
+    def add_honor(group: int, name: str, rarity: HonorRarity, assetbundleName: str | None = None,
+                  missionType: HonorMissionType | None = None) -> int:
+        nonlocal honorId
+        honorId += 1
+        session.add(Honor(id=honorId, seq=honorId, groupId=group, honorRarity=rarity.value, name=name,
+                          assetbundleName=assetbundleName, honorMissionType=missionType.value if missionType else None))
+        return honorId
+
+    def add_level(honor: int, level: int, description: str, rarity: HonorRarity | None = None, assetbundleName: str | None = None):
+        nonlocal levelId
+        levelId += 1
+        session.add(HonorLevel(id=str(levelId), honorId=honor, level=level, bonus=0, description=description,
+                               assetbundleName=assetbundleName, honorRarity=rarity.value if rarity else None))
+
+    for c in track(range(26 * scale), "Creating character titles...", transient=True):
+        assetbundleName = f'honor_chara_{c:04d}'
+        create_degree_assets(bake, os.path.join(bake.HONOR_PATH, assetbundleName), rng)
+        honor = add_honor(add_group(f'Character {c + 1} Fan', HonorType.CHARACTER), f'Character {c + 1} Fan', HonorRarity.LOW, assetbundleName)
+        for i, requirement in enumerate(range(5, 170, 5)):
+            add_level(honor, i % 10 + 1, f'Reach Character Rank {requirement}', RARITIES[min(i // 8, 3)])
+
+    for a in track(range(40 * scale), "Creating achievement titles...", transient=True):
+        group = add_group(f'Achievement {a}', HonorType.ACHIEVEMENT)
+        match a % 4:
+            case 0:  # One honor with levels
+                assetbundleName = f'honor_achievement_{a:04d}'
+                create_degree_assets(bake, os.path.join(bake.HONOR_PATH, assetbundleName), rng)
+                honor = add_honor(group, f'Achievement {a}', HonorRarity.MIDDLE, assetbundleName)
+                for level in range(1, 11):
+                    add_level(honor, level, f'Clear {level * 1000:,} songs')
+            case 1:  # An honor per level
+                for i in range(3):
+                    assetbundleName = f'honor_achievement_{a:04d}_{i}'
+                    create_degree_assets(bake, os.path.join(bake.HONOR_PATH, assetbundleName), rng)
+                    add_level(add_honor(group, f'Achievement {a} {i}', RARITIES[i], assetbundleName), 1, f'Play {10 ** (i + 1)} songs')
+            case 2:  # A single title
+                assetbundleName = f'honor_achievement_{a:04d}'
+                create_degree_assets(bake, os.path.join(bake.HONOR_PATH, assetbundleName), rng)
+                add_level(add_honor(group, f'Achievement {a}', HonorRarity.HIGH, assetbundleName), 1, 'Clear a song')
+            case 3:  # Full combo stars, with a scroll per level
+                honor = add_honor(group, f'Full Combo {a}', HonorRarity.HIGH, missionType=HonorMissionType.MASTER_FC)
+                for level in range(1, 21):
+                    assetbundleName = f'honor_scroll_{a:04d}_{level:02d}'
+                    create_degree_assets(bake, os.path.join(bake.HONOR_PATH, assetbundleName), rng)
+                    save_placeholder(os.path.join(bake.HONOR_PATH, assetbundleName, 'scroll.webp'), (140, 80), rng, False)
+                    add_level(honor, level, f'Full combo {level * 10} songs on Master', HonorRarity.HIGH, assetbundleName)
+
+    for e in track(range(30 * scale), "Creating event titles...", transient=True):
+        background = f'honor_event_{e:04d}'
+        create_degree_assets(bake, os.path.join(bake.HONOR_PATH, background), rng)
+        group = add_group(f'Event {e}', HonorType.EVENT, background)
+        for rank in range(3):
+            assetbundleName = f'honor_top_{e:04d}{rank:02d}' + ('_cp1' if e % 10 == 9 else '')
+            save_placeholder(os.path.join(bake.HONOR_PATH, assetbundleName, 'rank_main.webp'), (180, 80), rng, False)
+            save_placeholder(os.path.join(bake.HONOR_PATH, assetbundleName, 'rank_sub.webp'), (180, 40), rng, False)
+            add_honor(group, f'Event {e} Top {rank + 1}', RARITIES[3 - rank], assetbundleName)
+
+    for r in track(range(2 * scale), "Creating rank match titles...", transient=True):
+        background = f'rank_match_{r:02d}'
+        create_degree_assets(bake, os.path.join(bake.RANK_LIVE_PATH, background), rng)
+        group = add_group(f'Ranked Matches Season {r + 1}', HonorType.RANK_MATCH, background)
+        for tier in range(4):
+            assetbundleName = f'season_{r:02d}/tier_{tier}'
+            save_placeholder(os.path.join(bake.RANK_LIVE_PATH, *assetbundleName.split('/'), 'main.webp'), (180, 80), rng, False)
+            save_placeholder(os.path.join(bake.RANK_LIVE_PATH, *assetbundleName.split('/'), 'sub.webp'), (180, 40), rng, False)
+            add_honor(group, f'Season {r + 1} Class {tier + 1}', RARITIES[tier], assetbundleName)
+
+    session.commit()
+
+
+def run_bake(arguments: List[str]) -> float:
+    '''Runs bake-honors.py as it would be run normally and returns how long it took.'''
+    start = perf_counter()
+    result = subprocess.run([sys.executable, BAKE_SCRIPT, '-nu', *arguments], capture_output=True, text=True, encoding='utf8')
+    elapsed = perf_counter() - start
+    if result.returncode != 0:
+        print(result.stdout, result.stderr)
+        raise RuntimeError('bake-honors.py failed')
+    return elapsed
+
+
+def profile_stages(bake, session: Session, encoderName: str) -> Tuple[Dict[str, float], int]:
+    '''Renders every title in this process with empty layer caches, timing each layer and stage of the render.
+    Returns the total time per stage and the number of titles.'''
+    for cached in [bake.load_layer, bake.get_layer, bake.get_level_overlay, bake.get_level_layer]:
+        cached.cache_clear()
+    mainImages, subImages = bake.get_degree_images(bake.load_honor_groups(session))
+    encoder = bake.ENCODERS[encoderName]
+    times = dict.fromkeys(STAGES, 0.0)
+
+    for i in track([*mainImages, *subImages], "Profiling render stages...", transient=True):
+        start = perf_counter()
+
+        def lap(stage: str):
+            nonlocal start
+            now = perf_counter()
+            times[stage] += now - start
+            start = now
+
+        bgPath = i.get_bg_path()
+        layers = [(bake.get_layer(bgPath) if bgPath else None, (0, 0))]
+        lap('background')
+        layers.append((bake.get_layer(i.get_frame_path()), (0, 0)))
+        lap('frame')
+        layers.append(i.get_rank_layer())
+        lap('rank')
+        layers.append((i.get_level_layer(), (0, 0)))
+        lap('level')
+        im = bake.composite(bake.DEGREE_SUB_SIZE if i.isSub else bake.DEGREE_MAIN_SIZE, layers)
+        lap('composite')
+        bake.encode_image(im, encoder)
+        lap('encode')
+
+    return times, len(mainImages) + len(subImages)
+
+
+def benchmark(scale: int, jobs: int | None, encoder: str):
+    '''Generates the benchmark data in the current directory, which must be empty, then bakes it and profiles the
+    render stages.'''
+    bake = load_bake_module()
+    engine = create_engine(config.DATABASE_STRING)
+    Base.metadata.create_all(engine, tables=[t.__table__ for t in [HonorGroup, Honor, HonorLevel]])  # type: ignore
+    BenchSession = sessionmaker(bind=engine)
+
+    start = perf_counter()
+    with BenchSession() as session:
+        create_benchmark_data(bake, session, scale)
+    print(f'Created synthetic honors and layers in {os.getcwd()} in {perf_counter() - start:.2f}s')
+
+    arguments = ['--encoder', encoder, *(['--jobs', str(jobs)] if jobs else [])]
+    fullTime = run_bake([*arguments, '--force'])
+    with open(MANIFEST_PATH, 'r', encoding='utf8') as f:
+        titleCount = len(json.load(f))
+    bakePeak = peak_rss(children=True)
+    unchangedTime = run_bake(arguments)
+
+    with BenchSession() as session:
+        times, imageCount = profile_stages(bake, session, encoder)
+    total = sum(times.values())
+
+    print(f'{"Full bake":<16}{fullTime:>8.2f}s  {titleCount} files, {titleCount / fullTime:.1f} images/s, peak RSS {format_bytes(bakePeak)}')
+    print(f'{"Unchanged bake":<16}{unchangedTime:>8.2f}s')
+    print(f'Render stages over {imageCount} titles in one process ({imageCount / total:.1f} images/s), peak RSS {format_bytes(peak_rss())}:')
+    for stage in STAGES:
+        print(f'  {stage:<14}{times[stage]:>8.3f}s {times[stage] / total:>7.1%} {times[stage] / imageCount * 1000:>8.3f}ms per title')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog='bench-honors',
+        description='Benchmarks bake-honors.py on a synthetic set of honors and layer images, without needing the real assets or DB.'
+    )
+    parser.add_argument('-s', '--scale', type=int, default=1,
+                        help='Number of copies of a roughly real-sized set of honors to generate. Defaults to 1.')
+    parser.add_argument('-j', '--jobs', type=int, help='Passed on to bake-honors.py.')
+    parser.add_argument('-e', '--encoder', default='png', help='Passed on to bake-honors.py. Defaults to png.')
+    parser.add_argument('-d', '--directory',
+                        help='Generate the benchmark data in this directory and keep it afterwards, instead of in a temporary directory. The directory must be new or empty.')
+    args = vars(parser.parse_args())
+
+    # The benchmark writes its own db.sqlite and assets, so never let it near a directory with real ones in it
+    if args.get('directory') and os.path.isdir(args['directory']) and os.listdir(args['directory']):
+        parser.error(f'{args["directory"]} is not empty. Use a new or empty directory so no real data or assets are overwritten.')
+
+    cwd = os.getcwd()
+    with nullcontext(args['directory']) if args.get('directory') else tempfile.TemporaryDirectory(prefix='bench-honors-') as directory:
+        Path(directory).mkdir(parents=True, exist_ok=True)
+        os.chdir(directory)
+        try:
+            benchmark(args['scale'], args.get('jobs'), args['encoder'])
+        finally:
+            os.chdir(cwd)
@@ -5,10 +5,19 @@ DATA_REPOSITORY_JP_URL = 'https://github.com/Sekai-World/sekai-master-db-diff.gi
 DATA_DIRECTORY_JP = 'sekai-master-db-diff'
 DATABASE_STRING = 'sqlite:///db.sqlite'
 
+# Exports
+EXPORT_BATCH_SIZE = 500
+EXPORT_SNAPSHOT_RETENTION = 20 # Snapshots kept per table, None keeps all of them
+
 # Asset Repository
 ASSETS_REPOSITORY = 'https://github.com/yhsanave/prsk-sheet-assets.git'
 ASSETS_DIRECTORY = 'prsk-sheet-assets' 
+BAKE_MAX_WORKERS = None # Defaults to the number of CPU cores
 
 # Google API
 GOOGLE_API_KEY_PATH = 'api-key.json'
-MASTER_SHEET_ID = '18pW8BaVve-L4FuRj084chS37SPuxyYbGNyc8KEzWSSU'
\ No newline at end of file
+MASTER_SHEET_ID = '18pW8BaVve-L4FuRj084chS37SPuxyYbGNyc8KEzWSSU'
+SHEETS_READ_REQUESTS_PER_MINUTE = 60
+SHEETS_WRITE_REQUESTS_PER_MINUTE = 60
+SHEETS_MAX_RETRIES = 8
+SHEETS_MAX_WORKERS = 4
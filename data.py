@@ -9,11 +9,12 @@ from sqlalchemy.orm import sessionmaker
 
 import config
 from model import (Base, Card, CardEpisode, CardSupply, GameCharacter, GameCharacterUnit, Honor,
-                   HonorGroup, HonorLevel, Music, MusicArtist, MusicDifficulty,
+                   HonorGroup, HonorLevel, ImportInfo, Music, MusicArtist, MusicDifficulty,
                    MusicOriginal, MusicTag, MySekaiBlueprint, MySekaiCharacterTalk,
                    MySekaiCharacterTalkCondition, MySekaiCharacterTalkConditionGroup, MySekaiCharacterTalkPreAction,
                    MySekaiCharacterTalkTweet, MySekaiFixture, MySekaiFixtureTag, MySekaiGameCharacterUnitGroup,
                    Skill, Unit)
+from reactions import get_fixture_reactions_insert
 
 
 def merge_data(subset: Iterable, superset: Iterable) -> List:
@@ -51,7 +52,7 @@ def import_data():
     """Parse the data from the repository and insert it into the database."""
     engine = create_engine(config.DATABASE_STRING)
     Base.metadata.drop_all(engine, [Base.metadata.tables[t]
-                           for t in Base.metadata.tables if t.startswith('data_')])
+                           for t in Base.metadata.tables if t.startswith(('data_', 'derived_'))])
     Base.metadata.create_all(engine)
     Session = sessionmaker(bind=engine)
     session = Session()
@@ -700,6 +701,19 @@ def import_data():
     print(
         f"Imported {len(mySekaiCharacterTalkConditionGroups)} MySEKAI Character Talk Condition Groups")
 
+    # Build derived tables
+    session.flush()
+    fixtureReactions = session.execute(get_fixture_reactions_insert())
+    print(f"Derived {fixtureReactions.rowcount} fixture reactions.")  # type: ignore
+
+    # Record the import so exports can tell when the data has changed
+    session.add(ImportInfo(
+        id=1,
+        importedAt=datetime.now(),
+        enCommit=Repo(config.DATA_DIRECTORY_EN).head.commit.hexsha,
+        jpCommit=Repo(config.DATA_DIRECTORY_JP).head.commit.hexsha
+    ))
+
     session.commit()
     session.close()
 
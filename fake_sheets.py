@@ -0,0 +1,231 @@
+import json
+import random
+import re
+import threading
+import time
+from dataclasses import asdict, dataclass
+from typing import Any, Dict, List, Tuple
+
+A1_PATTERN = re.compile(r'^([A-Z]*)(\d*)$')
+
+
+def column_index(letters: str) -> int:
+    '''Converts a column label (A, B, ..., AA) to a 1-based column index.'''
+    index = 0
+    for c in letters:
+        index = index * 26 + ord(c) - ord('A') + 1
+    return index
+
+
+def parse_range(rangeName: str) -> Tuple[int, int, int | None, int | None]:
+    '''Parses an A1 range into 1-based (startRow, startCol, endRow, endCol). Open ends are None.'''
+    rangeName = rangeName.split('!')[-1].upper()
+    start, _, end = rangeName.partition(':')
+
+    startMatch = A1_PATTERN.match(start)
+    endMatch = A1_PATTERN.match(end or start)
+    if not startMatch or not endMatch:
+        raise ValueError(f'Invalid range: {rangeName}')
+
+    startCol = column_index(startMatch.group(1)) if startMatch.group(1) else 1
+    startRow = int(startMatch.group(2)) if startMatch.group(2) else 1
+    endCol = column_index(endMatch.group(1)) if endMatch.group(1) else None
+    endRow = int(endMatch.group(2)) if endMatch.group(2) else None
+    return startRow, startCol, endRow, endCol
+
+
+@dataclass
+class RequestRecord:
+    method: str
+    worksheet: str
+    ranges: List[str]
+    rows: int
+    cells: int
+    bytes: int
+    seconds: float
+    status: int = 200
+    body: Dict | None = None
+
+
+class FakeAPIError(Exception):
+    '''Raised for simulated API failures. Mirrors the `code` attribute of gspread.exceptions.APIError.'''
+
+    def __init__(self, code: int, message: str):
+        super().__init__(message)
+        self.code = code
+
+
+class FakeWorksheet:
+    '''In-memory worksheet implementing the subset of gspread.Worksheet used by the sheet updater.'''
+
+    def __init__(self, spreadsheet: 'FakeSpreadsheet', title: str):
+        self.spreadsheet = spreadsheet
+        self.title = title
+        self.cells: List[List[Any]] = []
+        self.lock = threading.Lock()
+
+    def _write(self, values: List[List[Any]], rangeName: str):
+        startRow, startCol, _, _ = parse_range(rangeName)
+        for r, row in enumerate(values):
+            rowIndex = startRow + r - 1
+            while len(self.cells) <= rowIndex:
+                self.cells.append([])
+            cells = self.cells[rowIndex]
+            while len(cells) < startCol - 1 + len(row):
+                cells.append('')
+            # Like the real API, null values leave the existing cell alone
+            for c, value in enumerate(row, startCol - 1):
+                if value is not None:
+                    cells[c] = value
+
+    def _clear(self, rangeName: str):
+        startRow, startCol, endRow, endCol = parse_range(rangeName)
+        for rowIndex in range(startRow - 1, min(endRow or len(self.cells), len(self.cells))):
+            cells = self.cells[rowIndex]
+            for colIndex in range(startCol - 1, min(endCol or len(cells), len(cells))):
+                cells[colIndex] = ''
+
+    def clear(self):
+        with self.spreadsheet.client.request('clear', self.title, [self.title], {}):
+            with self.lock:
+                self.cells = []
+
+    def batch_clear(self, ranges: List[str]):
+        with self.spreadsheet.client.request('batch_clear', self.title, ranges, {'ranges': ranges}):
+            with self.lock:
+                for r in ranges:
+                    self._clear(r)
+
+    def update(self, values: List[List[Any]] = None, range_name: str = 'A1', **kwargs):  # type: ignore
+        body = {'range': range_name, 'values': values}
+        with self.spreadsheet.client.request('update', self.title, [range_name], body, values):
+            with self.lock:
+                self._write(values, range_name)
+
+    def batch_update(self, data: List[Dict], **kwargs):
+        values = [row for d in data for row in d['values']]
+        with self.spreadsheet.client.request('batch_update', self.title, [d['range'] for d in data], {'data': data}, values):
+            with self.lock:
+                for d in data:
+                    self._write(d['values'], d['range'])
+
+    def col_values(self, col: int) -> List[Any]:
+        with self.spreadsheet.client.request('col_values', self.title, [], {}):
+            with self.lock:
+                values = [row[col-1] if len(row) >= col else '' for row in self.cells]
+        while values and values[-1] == '':
+            values.pop()
+        return values
+
+    def get_all_values(self) -> List[List[Any]]:
+        with self.spreadsheet.client.request('get_all_values', self.title, [], {}):
+            with self.lock:
+                return [list(row) for row in self.cells]
+
+
+class FakeSpreadsheet:
+    '''In-memory spreadsheet. Worksheets are created on first access.'''
+
+    def __init__(self, client: 'FakeClient', key: str):
+        self.client = client
+        self.id = key
+        self.worksheets: Dict[str, FakeWorksheet] = {}
+
+    def worksheet(self, title: str) -> FakeWorksheet:
+        with self.client.request('worksheet', title, [], {}):
+            with self.client.lock:
+                if title not in self.worksheets:
+                    self.worksheets[title] = FakeWorksheet(self, title)
+                return self.worksheets[title]
+
+
+class FakeClient:
+    '''Local stand-in for gspread.Client that keeps sheet state in memory and records every request.
+
+    `latency` adds a fixed delay to each request to approximate the round trip to the Sheets API and
+    `errorRate` is the fraction of requests that fail with a 429 before doing anything. With `keepBodies`
+    the request bodies are kept in the log as well as their sizes.'''
+
+    def __init__(self, latency: float = 0.0, errorRate: float = 0.0, keepBodies: bool = False):
+        self.latency = latency
+        self.errorRate = errorRate
+        self.keepBodies = keepBodies
+        self.spreadsheets: Dict[str, FakeSpreadsheet] = {}
+        self.records: List[RequestRecord] = []
+        self.lock = threading.RLock()
+
+    def open_by_key(self, key: str) -> FakeSpreadsheet:
+        with self.request('open_by_key', '', [], {}):
+            with self.lock:
+                if key not in self.spreadsheets:
+                    self.spreadsheets[key] = FakeSpreadsheet(self, key)
+                return self.spreadsheets[key]
+
+    def request(self, method: str, worksheet: str, ranges: List[str], body: Dict, values: List[List[Any]] = []):
+        '''Context manager that times a request and records its size.'''
+        return _Request(self, RequestRecord(
+            method=method,
+            worksheet=worksheet,
+            ranges=ranges,
+            rows=len(values),
+            cells=sum(len(row) for row in values),
+            bytes=len(json.dumps(body, default=str).encode('utf8')),
+            seconds=0,
+            body=body if self.keepBodies else None
+        ))
+
+    def summary(self) -> str:
+        '''Returns a per-worksheet table of request counts, bytes sent and time spent.'''
+        totals: Dict[str, List] = {}
+        for r in self.records:
+            t = totals.setdefault(r.worksheet or '(spreadsheet)', [0, 0, 0, 0.0])
+            t[0] += 1
+            t[1] += r.cells
+            t[2] += r.bytes
+            t[3] += r.seconds
+
+        errors = sum(1 for r in self.records if r.status != 200)
+        lines = [f'{"Worksheet":<20}{"Calls":>8}{"Cells":>10}{"Bytes":>12}{"Seconds":>10}']
+        for name, (calls, cells, size, seconds) in totals.items():
+            lines.append(f'{name:<20}{calls:>8}{cells:>10}{size:>12}{seconds:>10.3f}')
+        lines.append(
+            f'{"Total":<20}{len(self.records):>8}{sum(r.cells for r in self.records):>10}'
+            f'{sum(r.bytes for r in self.records):>12}{sum(r.seconds for r in self.records):>10.3f}')
+        if errors:
+            lines.append(f'{errors} requests failed')
+        return '\n'.join(lines)
+
+    def worksheet_records(self, worksheet: str) -> List[RequestRecord]:
+        with self.lock:
+            return [r for r in self.records if r.worksheet == worksheet]
+
+    def dump(self, path: str):
+        '''Writes the sheet state and request log to a JSON file.'''
+        with open(path, 'w', encoding='utf8') as f:
+            json.dump({
+                'spreadsheets': {
+                    key: {title: ws.cells for title, ws in s.worksheets.items()}
+                    for key, s in self.spreadsheets.items()
+                },
+                'requests': [asdict(r) for r in self.records]
+            }, f, default=str, ensure_ascii=False)
+
+
+class _Request:
+    def __init__(self, client: FakeClient, record: RequestRecord):
+        self.client = client
+        self.record = record
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        if self.client.latency:
+            time.sleep(self.client.latency)
+        if self.client.errorRate and random.random() < self.client.errorRate:
+            self.record.status = 429
+            self.__exit__()
+            raise FakeAPIError(429, 'Quota exceeded')
+
+    def __exit__(self, *exc):
+        self.record.seconds = time.perf_counter() - self.start
+        with self.client.lock:
+            self.client.records.append(self.record)
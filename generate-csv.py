@@ -1,28 +1,351 @@
+import argparse
 import csv
+import gzip
+import hashlib
+import io
+import json
 import os
+import sys
+import threading
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from importlib.util import find_spec
+from queue import Queue
+from time import perf_counter
+from typing import BinaryIO, Dict, List, Type
 
-from sqlalchemy import create_engine, select
+from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 
 import config
-from model import Card, Music
+from perf import format_bytes, peak_rss
+from snapshot import EXPORT_MODELS, SnapshotWriter, create_snapshot_table, get_source_key, new_run_id, stream_export_rows
 
-engine = create_engine(config.DATABASE_STRING)
-Session = sessionmaker(bind=engine)
-session = Session()
+MANIFEST_PATH = os.path.join("output", "manifest.json")
 
-# Cards
-with open(os.path.join("output", "cards.csv"), 'w', encoding='utf8', newline='') as f:
-    cards = [c.asdict() for c in session.execute(select(Card).order_by(Card.id)).scalars().all()]
 
-    writer = csv.DictWriter(f, fieldnames=cards[0].keys())
-    writer.writeheader()
-    writer.writerows(cards)
+class HashingFile(io.RawIOBase):
+    '''Write-only file wrapper that hashes and counts bytes as they are written.'''
 
-# Musics
-with open(os.path.join("output", "musics.csv"), 'w', encoding='utf8', newline='') as f:
-    musics = [m.asdict() for m in session.execute(select(Music).order_by(Music.id)).scalars().all()]
+    def __init__(self, path: str):
+        self.file = open(path, 'wb')
+        self.hash = hashlib.sha256()
+        self.size = 0
 
-    writer = csv.DictWriter(f, fieldnames=musics[0].keys())
-    writer.writeheader()
-    writer.writerows(musics)
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.hash.update(b)
+        self.size += len(b)
+        return self.file.write(b)
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        if not self.closed:
+            super().close()
+            self.file.close()
+
+
+class RowWriter:
+    '''Writes rows to a temp file next to the target path and moves it into place once complete, unless
+    the contents are identical to what is already there.'''
+    extension = ''
+
+    def __init__(self, path: str, headers: List[str], types: Dict[str, str] | None = None):
+        self.path = f'{path}.{self.extension}'
+        self.tempPath = f'{self.path}.tmp'
+        self.headers = headers
+        self.types = types or {}
+        self.raw = HashingFile(self.tempPath)
+
+    def write_batch(self, rows: List[List]):
+        raise NotImplementedError
+
+    def finish(self):
+        raise NotImplementedError
+
+    def close(self, previous: Dict | None = None) -> bool:
+        '''Finishes the file and returns whether the target was replaced.'''
+        self.finish()
+        self.raw.close()
+        if previous and previous['sha256'] == self.raw.hash.hexdigest() and os.path.exists(self.path) \
+                and os.path.getsize(self.path) == self.raw.size:
+            os.remove(self.tempPath)
+            return False
+        os.replace(self.tempPath, self.path)
+        return True
+
+    def abort(self):
+        try:
+            self.finish()
+        finally:
+            self.raw.close()
+            if os.path.exists(self.tempPath):
+                os.remove(self.tempPath)
+
+
+class TextRowWriter(RowWriter):
+    '''Base for text formats with optional gzip or zstd compression.'''
+    compression: str | None = None
+
+    def __init__(self, path: str, headers: List[str], types: Dict[str, str] | None = None):
+        super().__init__(path, headers, types)
+        self.stream: BinaryIO = self.raw  # type: ignore
+        if self.compression == 'gz':
+            # Fixed mtime so that unchanged data compresses to identical bytes
+            self.stream = gzip.GzipFile(filename='', mode='wb', fileobj=self.raw, mtime=0)  # type: ignore
+        elif self.compression == 'zst':
+            import zstandard
+            self.stream = zstandard.ZstdCompressor().stream_writer(self.raw, closefd=False)  # type: ignore
+        self.text = io.TextIOWrapper(self.stream, encoding='utf8', newline='')  # type: ignore
+
+    def finish(self):
+        if not self.text.closed:
+            self.text.close()
+
+
+class CsvWriter(TextRowWriter):
+    extension = 'csv'
+
+    def __init__(self, path: str, headers: List[str], types: Dict[str, str] | None = None):
+        super().__init__(path, headers, types)
+        self.writer = csv.writer(self.text)
+        self.writer.writerow(headers)
+
+    def write_batch(self, rows: List[List]):
+        self.writer.writerows(rows)
+
+
+class JsonlWriter(TextRowWriter):
+    extension = 'jsonl'
+
+    def write_batch(self, rows: List[List]):
+        self.text.writelines(json.dumps(dict(zip(self.headers, r)), ensure_ascii=False, default=str) + '\n' for r in rows)
+
+
+class CsvGzWriter(CsvWriter):
+    extension = 'csv.gz'
+    compression = 'gz'
+
+
+class JsonlGzWriter(JsonlWriter):
+    extension = 'jsonl.gz'
+    compression = 'gz'
+
+
+class CsvZstWriter(CsvWriter):
+    extension = 'csv.zst'
+    compression = 'zst'
+
+
+class JsonlZstWriter(JsonlWriter):
+    extension = 'jsonl.zst'
+    compression = 'zst'
+
+
+class ParquetWriter(RowWriter):
+    '''Columnar output for analytics. Each batch becomes a row group. Column types come from the model's ROW_TYPES
+    and are string otherwise, with empty strings treated as nulls in numeric and boolean columns.'''
+    extension = 'parquet'
+
+    def __init__(self, path: str, headers: List[str], types: Dict[str, str] | None = None):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        super().__init__(path, headers, types)
+        arrowTypes = {'bool': pa.bool_(), 'int': pa.int64(), 'float': pa.float64()}
+        self.schema = pa.schema([(h, arrowTypes.get(self.types.get(h, ''), pa.string())) for h in headers])
+        self.writer = pq.ParquetWriter(self.raw, self.schema)
+
+    def write_batch(self, rows: List[List]):
+        import pyarrow as pa
+
+        columns = list(zip(*rows))
+        arrays = []
+        for field, column in zip(self.schema, columns):
+            if pa.types.is_string(field.type):
+                values = [None if v is None else str(v) for v in column]
+            else:
+                values = [None if v == '' else v for v in column]
+            arrays.append(pa.array(values, type=field.type))
+        self.writer.write_table(pa.Table.from_arrays(arrays, schema=self.schema))  # type: ignore
+
+    def finish(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+
+WRITERS: Dict[str, Type[RowWriter]] = {w.extension: w for w in [
+    CsvWriter, JsonlWriter, CsvGzWriter, JsonlGzWriter, CsvZstWriter, JsonlZstWriter, ParquetWriter
+]}
+OPTIONAL_DEPENDENCIES = {
+    'csv.zst': 'zstandard',
+    'jsonl.zst': 'zstandard',
+    'parquet': 'pyarrow',
+}
+
+
+def get_available_formats() -> List[str]:
+    return [f for f in WRITERS if f not in OPTIONAL_DEPENDENCIES or find_spec(OPTIONAL_DEPENDENCIES[f])]
+
+
+class WriterThread(threading.Thread):
+    '''Feeds batches of rows from a queue to a single writer.'''
+
+    def __init__(self, writer: RowWriter, previous: Dict | None = None):
+        super().__init__(daemon=True)
+        self.writer = writer
+        self.previous = previous
+        self.queue: Queue = Queue(maxsize=4)
+        self.error: Exception | None = None
+        self.changed = False
+
+    def run(self):
+        while (batch := self.queue.get()) is not None:
+            if self.error:
+                continue
+            try:
+                self.writer.write_batch(batch)
+            except Exception as e:
+                self.error = e
+
+        if not self.error:
+            try:
+                self.changed = self.writer.close(self.previous)
+                return
+            except Exception as e:
+                self.error = e
+        try:
+            self.writer.abort()
+        except Exception:
+            pass
+
+
+def load_manifest() -> Dict[str, Dict]:
+    try:
+        with open(MANIFEST_PATH, encoding='utf8') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def save_manifest(manifest: Dict[str, Dict]):
+    tempPath = f'{MANIFEST_PATH}.tmp'
+    with open(tempPath, 'w', encoding='utf8') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tempPath, MANIFEST_PATH)
+
+
+def export_table(sessionFactory: sessionmaker, snapshot: SnapshotWriter, formats: List[str], manifest: Dict[str, Dict],
+                 batchSize: int = config.EXPORT_BATCH_SIZE) -> Dict[str, Dict]:
+    '''Loads an export table once and fans each batch of rows out to a writer per format. Returns the manifest
+    entries of the files that were written.'''
+    start = perf_counter()
+    firstRow = None
+    rowCount = 0
+
+    name = snapshot.name
+    model = EXPORT_MODELS[name]
+    threads = [WriterThread(WRITERS[f](os.path.join("output", name), list(model.ROW_HEADERS), model.ROW_TYPES),
+                            manifest.get(f'{name}.{f}')) for f in formats]
+    for t in threads:
+        t.start()
+
+    def send(batch: List[List]):
+        for t in threads:
+            t.queue.put(batch)
+
+    try:
+        batch = []
+        for row in stream_export_rows(sessionFactory, snapshot):
+            batch.append(row)
+            rowCount += 1
+            if firstRow is None:
+                firstRow = perf_counter() - start
+            if len(batch) >= batchSize:
+                send(batch)
+                batch = []
+        if batch:
+            send(batch)
+    except Exception as e:
+        # Don't let a partial export replace the previous output
+        for t in threads:
+            t.error = t.error or e
+        raise
+    finally:
+        send(None)  # type: ignore
+        for t in threads:
+            t.join()
+
+    entries = {}
+    for t in threads:
+        fileName = os.path.basename(t.writer.path)
+        if t.error:
+            print(f'Failed to write {t.writer.path}: {t.error}')
+        elif t.changed or t.previous is None:
+            entries[fileName] = {
+                'sha256': t.writer.raw.hash.hexdigest(),
+                'size': t.writer.raw.size,
+                'rows': rowCount,
+                'updatedAt': datetime.now().isoformat(timespec='seconds'),
+            }
+        else:
+            entries[fileName] = t.previous
+
+    unchanged = [f for f, t in zip(formats, threads) if not t.error and not t.changed]
+    print(f'Wrote {rowCount} {name} to {", ".join(formats)} in {perf_counter() - start:.2f}s '
+          f'(first row after {firstRow or 0:.3f}s)' + (f', unchanged: {", ".join(unchanged)}' if unchanged else ''))
+    return entries
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog='generate-csv',
+        description='Exports the card and music tables to the output directory.'
+    )
+    parser.add_argument('-f', '--formats', type=str, default='csv',
+                        help=f'Comma separated list of formats to write, or "all" for every available format. Supported: {", ".join(WRITERS)}.')
+    args = vars(parser.parse_args())
+
+    available = get_available_formats()
+    formats = available if args['formats'] == 'all' else args['formats'].split(',')
+    for f in formats:
+        if f not in WRITERS:
+            parser.error(f'Unknown format {f}')
+        if f not in available:
+            parser.error(f'{f} needs the {OPTIONAL_DEPENDENCIES[f]} package to be installed')
+
+    engine = create_engine(config.DATABASE_STRING)
+    create_snapshot_table(engine)
+    Session = sessionmaker(bind=engine)
+    runId = new_run_id()
+    os.makedirs("output", exist_ok=True)
+
+    with Session() as session:
+        sourceKey = get_source_key(session)
+    snapshots = [SnapshotWriter(name, list(EXPORT_MODELS[name].ROW_HEADERS), runId, sourceKey) for name in EXPORT_MODELS]
+
+    manifest = load_manifest()
+    entries = {}
+    start = perf_counter()
+    with ThreadPoolExecutor(max_workers=len(EXPORT_MODELS)) as pool:
+        for f in [pool.submit(export_table, Session, s, formats, manifest) for s in snapshots]:
+            entries.update(f.result())
+
+    # Saved once every table has been read, as SQLite can't commit while another export still has its cursor open
+    with Session() as session:
+        for s in snapshots:
+            s.save(session)
+
+    if any(manifest.get(k) != v for k, v in entries.items()):
+        save_manifest(manifest | entries)
+    print(f'Finished in {perf_counter() - start:.2f}s, peak RSS {format_bytes(peak_rss())}')
+
+    failed = [f'{name}.{f}' for name in EXPORT_MODELS for f in formats if f'{name}.{f}' not in entries]
+    if failed:
+        print(f'Failed to export {", ".join(failed)}')
+        sys.exit(1)
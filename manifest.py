@@ -0,0 +1,60 @@
+import json
+import os
+from dataclasses import asdict, dataclass
+from typing import List
+
+import config
+
+BAKED_PATH = os.path.join(config.ASSETS_DIRECTORY, 'honor_baked')
+MANIFEST_PATH = os.path.join(BAKED_PATH, 'manifest.json')
+
+
+@dataclass
+class BakedTitle:
+    '''A baked title image. Greyed out variants have level and requirement 0.'''
+    path: str  # Relative to BAKED_PATH, '/' separated
+    honorType: str
+    groupId: int
+    size: str  # main or sub
+    level: int | None
+    requirement: int | None
+    inputHash: str | None = None  # Hash of everything used to render the image, used to skip unchanged titles
+    contentHash: str | None = None  # SHA-256 of the saved file
+    aliasOf: str | None = None  # Path of an identical title whose file this one uses instead of having its own
+
+    @property
+    def file(self) -> str:
+        '''The path the image is stored at, which is another title's for aliases.'''
+        return self.aliasOf or self.path
+
+    @property
+    def directory(self) -> str:
+        return self.path.split('/')[1]
+
+    @property
+    def label(self) -> str:
+        '''The title name as shown in the sheets, taken from the group directory name.'''
+        return self.directory.split('-', 1)[1].replace('-', ' ')
+
+    def sort_key(self):
+        return (self.groupId, self.requirement is None, self.requirement or 0, self.path)
+
+
+def get_manifest_path(path: str) -> str:
+    '''Converts a path under BAKED_PATH to the form used in the manifest.'''
+    return os.path.relpath(path, BAKED_PATH).replace(os.sep, '/')
+
+
+def load_manifest(path: str = MANIFEST_PATH) -> List[BakedTitle]:
+    '''Returns every baked title in sorted order.'''
+    with open(path, 'r', encoding='utf8') as f:
+        titles = [BakedTitle(**t) for t in json.load(f)]
+    return sorted(titles, key=BakedTitle.sort_key)
+
+
+def save_manifest(titles: List[BakedTitle], path: str = MANIFEST_PATH):
+    '''Writes the manifest through a temp file, so an interrupted bake never leaves a partial manifest.'''
+    tempPath = f'{path}.tmp'
+    with open(tempPath, 'w', encoding='utf8') as f:
+        json.dump([asdict(t) for t in sorted(titles, key=BakedTitle.sort_key)], f, indent=1, ensure_ascii=False)
+    os.replace(tempPath, path)
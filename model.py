@@ -3,7 +3,7 @@ from enum import Enum
 import os
 from typing import Dict, List, Optional
 
-from sqlalchemy import Boolean, Date, Float, ForeignKey, Integer, String
+from sqlalchemy import Boolean, Date, DateTime, Float, ForeignKey, Integer, LargeBinary, String
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
 
 import config
@@ -158,6 +158,15 @@ EVENT_PRIORITY_TEXT_MAP = [
 ]
 
 
+class ImportInfo(Base):
+    __tablename__ = 'data_importInfo'
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    importedAt: Mapped[datetime.datetime] = mapped_column(DateTime)
+    enCommit: Mapped[Optional[str]] = mapped_column(String(40))
+    jpCommit: Mapped[Optional[str]] = mapped_column(String(40))
+
+
 class Unit(Base):
     __tablename__ = 'data_units'
 
@@ -277,6 +286,15 @@ class Card(Base):
     availableEN: Mapped[bool] = mapped_column(Boolean)
     sideStories: Mapped[List["CardEpisode"]] = relationship()
 
+    # Column order of asdict(), so exports can write headers without an instance
+    ROW_HEADERS = ['ID', 'Seq', 'Card Name', 'Character', 'Group', 'Subgroup', 'Attribute', 'Rarity',
+                   'Release Date', 'Availability', 'Skill', 'Thumbnail URL Normal', 'Available on EN',
+                   'Has Side Stories', 'Thumbnail URL Trained', 'Event Priority Int', 'Event Priority Str',
+                   'Event Priority Text']
+    # Types of the non-string row values, so typed exports don't depend on the values that happen to come first
+    ROW_TYPES = {'ID': 'int', 'Seq': 'int', 'Available on EN': 'bool', 'Has Side Stories': 'bool',
+                 'Event Priority Int': 'int'}
+
     def __hash__(self):
         return self.id
 
@@ -306,10 +324,11 @@ class Card(Base):
         }
 
     def to_row(self) -> List:
-        return list(self.asdict().values())
+        d = self.asdict()
+        return [d[h] for h in self.ROW_HEADERS]
 
     def get_row_headers(self) -> List[str]:
-        return list(self.asdict().keys())
+        return list(self.ROW_HEADERS)
 
     def get_event_priority(self) -> Dict:
         '''Returns the event priority values as a dict for output to sheets. Used in Event Coverage table.'''
@@ -391,6 +410,17 @@ class Music(Base):
     tags: Mapped[List["MusicTag"]] = relationship()
     videoLink: Mapped["MusicOriginal"] = relationship()
 
+    # Column order of asdict(), so exports can write headers without an instance
+    ROW_HEADERS = ['ID', 'Seq', 'Title', 'Unit', 'Producer', 'Lyricist', 'Composer', 'Arranger', 'Published',
+                   'Released', 'Filler Sec', 'Jacket URL', '3D MV', '2D MV', 'Original', 'Image',
+                   'Available on EN', 'Easy LV', 'Normal LV', 'Hard LV', 'Expert LV', 'Master LV',
+                   'Append LV', 'Easy Notes', 'Normal Notes', 'Hard Notes', 'Expert Notes', 'Master Notes',
+                   'Append Notes', 'Video Link']
+    # Types of the non-string row values, see Card.ROW_TYPES
+    ROW_TYPES = {'ID': 'int', 'Seq': 'int', 'Filler Sec': 'float', '3D MV': 'bool', '2D MV': 'bool',
+                 'Original': 'bool', 'Image': 'bool', 'Available on EN': 'bool',
+                 **{f'{d} {s}': 'int' for s in ['LV', 'Notes'] for d in ['Easy', 'Normal', 'Hard', 'Expert', 'Master', 'Append']}}
+
     def __hash__(self):
         return self.id
 
@@ -460,10 +490,11 @@ class Music(Base):
         }
 
     def to_row(self) -> List:
-        return list(self.asdict().values())
+        d = self.asdict()
+        return [d[h] for h in self.ROW_HEADERS]
 
     def get_row_headers(self) -> List[str]:
-        return list(self.asdict().keys())
+        return list(self.ROW_HEADERS)
 
     def is_removed(self) -> bool:
         '''Returns True if the song has been removed. Removed songs have no release date, so it gets set to 1969-12-31.'''
@@ -751,3 +782,28 @@ class MySekaiCharacterTalkPreAction(Base):
     mysekaiCharacterTalk: Mapped[MySekaiCharacterTalk] = relationship()
     mysekaiCharacterTalkTweet: Mapped[MySekaiCharacterTalkTweet] = relationship(
     )
+
+
+# Derived
+class FixtureReaction(Base):
+    '''Number of fixture talks each character unit appears in, materialized at the end of each import.'''
+    __tablename__ = 'derived_fixtureReactions'
+
+    fixtureId: Mapped[int] = mapped_column(Integer, primary_key=True)
+    gameCharacterUnitId: Mapped[int] = mapped_column(Integer, primary_key=True)
+    talkCount: Mapped[int] = mapped_column(Integer)
+
+
+# Exports
+class ExportSnapshot(Base):
+    __tablename__ = 'export_snapshots'
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    runId: Mapped[str] = mapped_column(String(32))
+    name: Mapped[str] = mapped_column(String(30))
+    createdAt: Mapped[datetime.datetime] = mapped_column(DateTime)
+    formatVersion: Mapped[int] = mapped_column(Integer)
+    sourceKey: Mapped[Optional[str]] = mapped_column(String(64))
+    contentHash: Mapped[str] = mapped_column(String(64))
+    rowCount: Mapped[int] = mapped_column(Integer)
+    data: Mapped[bytes] = mapped_column(LargeBinary)
@@ -1,53 +1,184 @@
+import argparse
+import csv
+import os
+import random
+from time import perf_counter
+from typing import Dict, List
+
 from sqlalchemy import create_engine, select
+from sqlalchemy.exc import OperationalError
 from sqlalchemy.orm import Session, sessionmaker
 
+import config
 from model import *
-import csv
+from reactions import (PIAPRO_UNIT, UNIT_ABBREVIATIONS, ReactionMatrix, build_reaction_matrices, get_fixture_reactions_insert,
+                       load_fixture_matrix)
+
+OUTPUT_NAMES = {
+    MySekaiCharacterTalkConditionType.FIXTURE: "mysekai-react-grid.csv",
+    MySekaiCharacterTalkConditionType.PHENOMENA: "mysekai-react-grid-phenomena.csv",
+    MySekaiCharacterTalkConditionType.VISIT_COUNT: "mysekai-react-grid-visit-count.csv",
+    MySekaiCharacterTalkConditionType.EVENT_STORY: "mysekai-react-grid-event-story.csv",
+}
+LABEL_HEADERS = {
+    MySekaiCharacterTalkConditionType.FIXTURE: "Fixture",
+    MySekaiCharacterTalkConditionType.PHENOMENA: "Phenomena",
+    MySekaiCharacterTalkConditionType.VISIT_COUNT: "Visit Count",
+    MySekaiCharacterTalkConditionType.EVENT_STORY: "Event Story Episode",
+}
+
+
+def get_fixture_names(session: Session) -> Dict[int, str]:
+    return {id: name for id, name in session.execute(select(MySekaiFixture.id, MySekaiFixture.name))}
+
+
+def get_grid_rows(session: Session) -> List[List[str]]:
+    matrix = build_reaction_matrices(session, [MySekaiCharacterTalkConditionType.FIXTURE])[MySekaiCharacterTalkConditionType.FIXTURE]
+    return matrix.to_rows(get_fixture_names(session))
+
+
+def get_derived_grid_rows(session: Session) -> List[List[str]]:
+    return load_fixture_matrix(session).to_rows(get_fixture_names(session))
+
+
+def get_matrices(session: Session) -> Dict[MySekaiCharacterTalkConditionType, ReactionMatrix]:
+    '''Reads fixture reactions from the table derived on import, falling back to scanning the talks for databases imported before it existed.'''
+    try:
+        fixtureMatrix = load_fixture_matrix(session)
+    except OperationalError:
+        session.rollback()
+        return build_reaction_matrices(session)
+
+    otherTypes = [t for t in MySekaiCharacterTalkConditionType if t != MySekaiCharacterTalkConditionType.FIXTURE]
+    return {MySekaiCharacterTalkConditionType.FIXTURE: fixtureMatrix, **build_reaction_matrices(session, otherTypes)}
+
+
+def get_legacy_grid_rows(session: Session) -> List[List[str]]:
+    '''The original grid walk, loading each talk's groups lazily. Only used to benchmark against.'''
+    fixtures = session.execute(
+        select(MySekaiFixture)
+        .order_by(MySekaiFixture.id)
+    ).scalars().all()
+
+    talks = session.execute(
+        select(MySekaiCharacterTalk)
+        .join(MySekaiCharacterTalkConditionGroup, MySekaiCharacterTalk.mysekaiCharacterTalkConditionGroupId == MySekaiCharacterTalkConditionGroup.groupId)
+        .join(MySekaiCharacterTalkCondition, MySekaiCharacterTalkConditionGroup.mysekaiCharacterTalkConditionId == MySekaiCharacterTalkCondition.id)
+        .where(MySekaiCharacterTalkCondition.mysekaiCharacterTalkConditionType == MySekaiCharacterTalkConditionType.FIXTURE.value)
+    ).scalars().all()
+
+    grid = {}
+    for f in fixtures:
+        grid[f.id] = {
+            "Fixture": f.name,
+            "Reactions": ["FALSE"] * 56
+        }
+
+    for t in talks:
+        for unitId in t.mysekaiGameCharacterUnitGroup.get_gameCharacterUnitIds():
+            grid[t.mysekaiCharacterTalkConditionGroup.mysekaiCharacterTalkCondition.mysekaiCharacterTalkConditionTypeValue][
+                "Reactions"][unitId-1] = "TRUE"
+
+    return [[r["Fixture"], *r["Reactions"]] for r in grid.values() if "TRUE" in r["Reactions"]]
+
+
+def write_grid(headers: List[str], rows: List[List[str]], path: str):
+    with open(path, "w+", encoding="utf8") as f:
+        writer = csv.writer(f, lineterminator='\n')
+        writer.writerow(headers)
+        writer.writerows(rows)
+
+
+def write_grids(session: Session):
+    '''Writes a grid for every talk condition type.'''
+    labels = {MySekaiCharacterTalkConditionType.FIXTURE: get_fixture_names(session)}
+    for conditionType, matrix in get_matrices(session).items():
+        write_grid(
+            [LABEL_HEADERS[conditionType], *matrix.columns.headers],
+            matrix.to_rows(labels.get(conditionType)),
+            os.path.join("output", OUTPUT_NAMES[conditionType])
+        )
+
+
+def create_benchmark_data(session: Session, scale: int):
+    '''Fills an empty database with a synthetic set of fixtures and talks, roughly scale times the size of the real data.'''
+    rng = random.Random(0)
+    units = list(UNIT_ABBREVIATIONS)
+    session.add_all(Unit(unit=u, seq=i, unitName=u) for i, u in enumerate(units))
+    session.add_all(GameCharacter(
+        id=i + 1, givenName=f'Character {i + 1}', gender='', unitId=units[min(i // 4, 5)]
+    ) for i in range(26))
+    characterUnits = [(c, units[min(c // 4, 5)]) for c in range(26)] + [(c, u) for c in range(20, 26) for u in units if u != PIAPRO_UNIT]
+    session.add_all(GameCharacterUnit(
+        id=i + 1, gameCharacterId=c + 1, unitName=u, colorCode='', skinColorCode='', skinShadowColorCode1='', skinShadowColorCode2=''
+    ) for i, (c, u) in enumerate(characterUnits))
+    unitCount = len(characterUnits)
+    types = [t.value for t in MySekaiCharacterTalkConditionType]
+    fixtureCount, groupCount, unitGroupCount, talkCount = 600 * scale, 1500 * scale, 300, 6000 * scale
+
+    session.add_all(MySekaiFixture(
+        id=i, seq=i, mysekaiFixtureType='normal', name=f'Fixture {i}', pronunciation='', flavorText='',
+        gridWidth=1, gridDepth=1, gridHeight=1, mysekaiFixtureMainGenreId=1, mysekaiFixtureHandleType='',
+        mysekaiSettableSiteType='', mysekaiSettableLayoutType='', mysekaiFixturePutType='', mysekaiFixturePutSoundId=1,
+        isAssembled=True, isDisassembled=True, mysekaiFixturePlayerActionType='', isGameCharacterAction=False, assetbundleName=''
+    ) for i in range(1, fixtureCount + 1))
+    session.add_all(MySekaiCharacterTalkCondition(
+        id=i, mysekaiCharacterTalkConditionType=rng.choice(types), mysekaiCharacterTalkConditionTypeValue=rng.randint(1, fixtureCount)
+    ) for i in range(1, groupCount + 1))
+    session.add_all(MySekaiCharacterTalkConditionGroup(
+        id=i, groupId=i, mysekaiCharacterTalkConditionId=i
+    ) for i in range(1, groupCount + 1))
+    session.add_all(MySekaiGameCharacterUnitGroup(
+        id=i, **{f'gameCharacterUnitId{n + 1}': u for n, u in enumerate(rng.sample(range(1, unitCount + 1), rng.randint(1, 5)))}
+    ) for i in range(1, unitGroupCount + 1))
+    session.add_all(MySekaiCharacterTalk(
+        id=i, mysekaiGameCharacterUnitGroupId=rng.randint(1, unitGroupCount), mysekaiCharacterTalkConditionGroupId=rng.randint(1, groupCount),
+        mysekaiSiteGroupId=1, mysekaiCharacterTalkTermId=1, characterArchiveMysekaiCharacterTalkGroupId=1, assetbundleName='', lua='',
+        isEnabledForMulti=False
+    ) for i in range(1, talkCount + 1))
+    session.commit()
+
+
+def benchmark(scale: int):
+    engine = create_engine('sqlite://')
+    Base.metadata.create_all(engine, tables=[t.__table__ for t in [  # type: ignore
+        Unit, GameCharacter, GameCharacterUnit, MySekaiFixture, MySekaiCharacterTalkCondition, MySekaiCharacterTalkConditionGroup,
+        MySekaiGameCharacterUnitGroup, MySekaiCharacterTalk, FixtureReaction
+    ]])
+    BenchSession = sessionmaker(bind=engine)
+    with BenchSession() as session:
+        create_benchmark_data(session, scale)
+
+    with BenchSession() as session:
+        start = perf_counter()
+        session.execute(get_fixture_reactions_insert())
+        session.commit()
+        print(f'{"derive":<8}{perf_counter() - start:>8.3f}s  (once per import)')
+
+    results = {}
+    for name, fn in [('legacy', get_legacy_grid_rows), ('joined', get_grid_rows), ('derived', get_derived_grid_rows)]:
+        with BenchSession() as session:
+            start = perf_counter()
+            rows = fn(session)
+            results[name] = rows
+            print(f'{name:<8}{perf_counter() - start:>8.3f}s  {len(rows)} rows')
+
+    print('Outputs match.' if results['legacy'] == results['joined'] == results['derived'] else 'Outputs differ!')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog='mysekai-react-grid',
+        description='Generates grids of which characters react to each MySekai fixture, phenomena, visit count and event story.'
+    )
+    parser.add_argument('--benchmark', type=int, metavar='SCALE',
+                        help='Compare the grid query against the original per-talk walk on a synthetic database of the given scale instead.')
+    args = vars(parser.parse_args())
 
-# Database Setup
-engine = create_engine(config.DATABASE_STRING)
-Session = sessionmaker(bind=engine)
-session = Session()
-
-fixtures = session.execute(
-    select(MySekaiFixture)
-    .order_by(MySekaiFixture.id)
-).scalars().all()
-
-talks = session.execute(
-    select(MySekaiCharacterTalk)
-    .join(MySekaiCharacterTalkConditionGroup, MySekaiCharacterTalk.mysekaiCharacterTalkConditionGroupId == MySekaiCharacterTalkConditionGroup.groupId)
-    .join(MySekaiCharacterTalkCondition, MySekaiCharacterTalkConditionGroup.mysekaiCharacterTalkConditionId == MySekaiCharacterTalkCondition.id)
-    .where(MySekaiCharacterTalkCondition.mysekaiCharacterTalkConditionType == MySekaiCharacterTalkConditionType.FIXTURE.value)
-).scalars().all()
-
-grid = {}
-for f in fixtures:
-    grid[f.id] = {
-        "Fixture": f.name,
-        "Reactions": ["FALSE"] * 56
-    }
-
-for t in talks:
-    if t.mysekaiGameCharacterUnitGroup.gameCharacterUnitId1:
-        grid[t.mysekaiCharacterTalkConditionGroup.mysekaiCharacterTalkCondition.mysekaiCharacterTalkConditionTypeValue][
-            "Reactions"][t.mysekaiGameCharacterUnitGroup.gameCharacterUnitId1-1] = "TRUE"
-    if t.mysekaiGameCharacterUnitGroup.gameCharacterUnitId2:
-        grid[t.mysekaiCharacterTalkConditionGroup.mysekaiCharacterTalkCondition.mysekaiCharacterTalkConditionTypeValue][
-            "Reactions"][t.mysekaiGameCharacterUnitGroup.gameCharacterUnitId2-1] = "TRUE"
-    if t.mysekaiGameCharacterUnitGroup.gameCharacterUnitId3:
-        grid[t.mysekaiCharacterTalkConditionGroup.mysekaiCharacterTalkCondition.mysekaiCharacterTalkConditionTypeValue][
-            "Reactions"][t.mysekaiGameCharacterUnitGroup.gameCharacterUnitId3-1] = "TRUE"
-    if t.mysekaiGameCharacterUnitGroup.gameCharacterUnitId4:
-        grid[t.mysekaiCharacterTalkConditionGroup.mysekaiCharacterTalkCondition.mysekaiCharacterTalkConditionTypeValue][
-            "Reactions"][t.mysekaiGameCharacterUnitGroup.gameCharacterUnitId4-1] = "TRUE"
-    if t.mysekaiGameCharacterUnitGroup.gameCharacterUnitId5:
-        grid[t.mysekaiCharacterTalkConditionGroup.mysekaiCharacterTalkCondition.mysekaiCharacterTalkConditionTypeValue][
-            "Reactions"][t.mysekaiGameCharacterUnitGroup.gameCharacterUnitId5-1] = "TRUE"
-
-with open(os.path.join("output","mysekai-react-grid.csv"), "w+", encoding="utf8") as f:
-    print("Fixture,Ichika,Saki,Honami,Shiho,Minori,Haruka,Airi,Shizuku,Kohane,An,Akito,Toya,Tsukasa,Emu,Nene,Rui,Kanade,Mafuyu,Ena,Mizuki,VS Miku,VS Rin,VS Len,VS Luka,VS Meiko,VS Kaito,LN Miku,MMJ Miku,VBS Miku,WxS Miku,N25 Miku,LN Rin,MMJ Rin,VBS Rin,WxS Rin,N25 Rin,LN Len,MMJ Len,VBS Len,WxS Len,N25 Len,LN Luka,MMJ Luka,VBS Luka,WxS Luka,N25 Luka,LN Meiko,MMJ Meiko,VBS Meiko,WxS Meiko,N25 Meiko,LN Kaito,MMJ Kaito,VBS Kaito,WxS Kaito,N25 Kaito", file=f)
-    for r in grid.values():
-        if any(map(lambda x: x == "TRUE", r["Reactions"])):
-            row = ','.join([r["Fixture"], *r["Reactions"]])
-            print(row, file=f)
+    if args.get('benchmark'):
+        benchmark(args['benchmark'])
+    else:
+        engine = create_engine(config.DATABASE_STRING)
+        Session = sessionmaker(bind=engine)
+        with Session() as session:
+            write_grids(session)
@@ -0,0 +1,140 @@
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, List
+
+from sqlalchemy import func, insert, select, union_all
+from sqlalchemy.orm import Session
+
+from model import (FixtureReaction, GameCharacter, GameCharacterUnit, MySekaiCharacterTalk, MySekaiCharacterTalkCondition,
+                   MySekaiCharacterTalkConditionGroup, MySekaiCharacterTalkConditionType, MySekaiGameCharacterUnitGroup, Unit)
+
+PIAPRO_UNIT = 'piapro'
+# data_units only has the full unit names (e.g. "Nightcord at 25:00"), and the short names used in the sheets can't be
+# derived from them. Units missing from here are labelled with their full name.
+UNIT_ABBREVIATIONS = {
+    'light_sound': 'LN',
+    'idol': 'MMJ',
+    'street': 'VBS',
+    'theme_park': 'WxS',
+    'school_refusal': 'N25',
+    'piapro': 'VS',
+}
+UNIT_COLUMNS = [
+    MySekaiGameCharacterUnitGroup.gameCharacterUnitId1,
+    MySekaiGameCharacterUnitGroup.gameCharacterUnitId2,
+    MySekaiGameCharacterUnitGroup.gameCharacterUnitId3,
+    MySekaiGameCharacterUnitGroup.gameCharacterUnitId4,
+    MySekaiGameCharacterUnitGroup.gameCharacterUnitId5,
+]
+
+
+@dataclass
+class CharacterUnitColumns:
+    '''The character unit columns of a reaction matrix, in game character unit id order.'''
+    ids: List[int]
+    headers: List[str]
+    index: Dict[int, int] = field(init=False)
+
+    def __post_init__(self):
+        self.index = {id: i for i, id in enumerate(self.ids)}
+
+
+@dataclass
+class ReactionMatrix:
+    '''Which character units have a talk for each value of a condition type. Each row is a bitmask with bit n
+    set if the character unit in column n reacts.'''
+    conditionType: MySekaiCharacterTalkConditionType
+    columns: CharacterUnitColumns
+    rows: Dict[int, int] = field(default_factory=dict)
+
+    def get_cells(self, value: int) -> List[str]:
+        mask = self.rows.get(value, 0)
+        return ["TRUE" if mask >> i & 1 else "FALSE" for i in range(len(self.columns.ids))]
+
+    def to_rows(self, labels: Dict[int, str] | None = None) -> List[List[str]]:
+        '''Returns a row per condition value with any reactions, labelled by name if given. Values without a label are skipped
+        when labels are given.'''
+        return [
+            [labels[value] if labels is not None else str(value), *self.get_cells(value)]
+            for value in sorted(self.rows) if self.rows[value] and (labels is None or value in labels)
+        ]
+
+
+def get_character_unit_columns(session: Session) -> CharacterUnitColumns:
+    '''Names each character unit after the character, with the unit prefixed for virtual singers (e.g. VS Miku, LN Miku).'''
+    characterUnits = session.execute(
+        select(GameCharacterUnit.id, GameCharacterUnit.unitName, Unit.unitName, GameCharacter.givenName, GameCharacter.unitId)
+        .join(GameCharacter, GameCharacterUnit.gameCharacterId == GameCharacter.id)
+        .outerjoin(Unit, GameCharacterUnit.unitName == Unit.unit)
+        .order_by(GameCharacterUnit.id)
+    ).all()
+
+    ids, headers = [], []
+    for id, unit, unitName, givenName, characterUnit in characterUnits:
+        ids.append(id)
+        if characterUnit == PIAPRO_UNIT:
+            headers.append(f'{UNIT_ABBREVIATIONS.get(unit) or unitName or unit} {givenName.capitalize()}')
+        else:
+            headers.append(givenName)
+    return CharacterUnitColumns(ids, headers)
+
+
+def build_reaction_matrices(session: Session, conditionTypes: Iterable[MySekaiCharacterTalkConditionType] = MySekaiCharacterTalkConditionType) -> Dict[MySekaiCharacterTalkConditionType, ReactionMatrix]:
+    '''Builds a reaction matrix for each condition type from a single scan of the talk tables.'''
+    columns = get_character_unit_columns(session)
+    matrices = {t: ReactionMatrix(t, columns) for t in conditionTypes}
+    byValue = {t.value: m for t, m in matrices.items()}
+
+    talks = session.execute(
+        select(MySekaiCharacterTalkCondition.mysekaiCharacterTalkConditionType,
+               MySekaiCharacterTalkCondition.mysekaiCharacterTalkConditionTypeValue, *UNIT_COLUMNS)
+        .select_from(MySekaiCharacterTalk)
+        .join(MySekaiCharacterTalkConditionGroup, MySekaiCharacterTalk.mysekaiCharacterTalkConditionGroupId == MySekaiCharacterTalkConditionGroup.groupId)
+        .join(MySekaiCharacterTalkCondition, MySekaiCharacterTalkConditionGroup.mysekaiCharacterTalkConditionId == MySekaiCharacterTalkCondition.id)
+        .join(MySekaiGameCharacterUnitGroup, MySekaiCharacterTalk.mysekaiGameCharacterUnitGroupId == MySekaiGameCharacterUnitGroup.id)
+        .where(MySekaiCharacterTalkCondition.mysekaiCharacterTalkConditionType.in_(byValue.keys()))
+        .distinct()
+    )
+
+    for conditionType, value, *unitIds in talks:
+        mask = 0
+        for unitId in unitIds:
+            if unitId in columns.index:
+                mask |= 1 << columns.index[unitId]
+        rows = byValue[conditionType].rows
+        rows[value] = rows.get(value, 0) | mask
+
+    return matrices
+
+
+def get_fixture_reactions_insert():
+    '''Returns an INSERT ... SELECT that fills derived_fixtureReactions by unrolling the five unit columns of every fixture talk.'''
+    pairs = union_all(*[
+        select(
+            MySekaiCharacterTalkCondition.mysekaiCharacterTalkConditionTypeValue.label('fixtureId'),
+            column.label('gameCharacterUnitId'),
+            MySekaiCharacterTalk.id.label('talkId')
+        )
+        .select_from(MySekaiCharacterTalk)
+        .join(MySekaiCharacterTalkConditionGroup, MySekaiCharacterTalk.mysekaiCharacterTalkConditionGroupId == MySekaiCharacterTalkConditionGroup.groupId)
+        .join(MySekaiCharacterTalkCondition, MySekaiCharacterTalkConditionGroup.mysekaiCharacterTalkConditionId == MySekaiCharacterTalkCondition.id)
+        .join(MySekaiGameCharacterUnitGroup, MySekaiCharacterTalk.mysekaiGameCharacterUnitGroupId == MySekaiGameCharacterUnitGroup.id)
+        .where(MySekaiCharacterTalkCondition.mysekaiCharacterTalkConditionType == MySekaiCharacterTalkConditionType.FIXTURE.value)
+        .where(column.is_not(None))
+        for column in UNIT_COLUMNS
+    ]).subquery()
+
+    return insert(FixtureReaction).from_select(
+        ['fixtureId', 'gameCharacterUnitId', 'talkCount'],
+        select(pairs.c.fixtureId, pairs.c.gameCharacterUnitId, func.count(pairs.c.talkId.distinct()))
+        .group_by(pairs.c.fixtureId, pairs.c.gameCharacterUnitId)
+    )
+
+
+def load_fixture_matrix(session: Session) -> ReactionMatrix:
+    '''Builds the fixture reaction matrix from the derived table instead of scanning the talk tables.'''
+    columns = get_character_unit_columns(session)
+    matrix = ReactionMatrix(MySekaiCharacterTalkConditionType.FIXTURE, columns)
+    for fixtureId, unitId in session.execute(select(FixtureReaction.fixtureId, FixtureReaction.gameCharacterUnitId)):
+        if unitId in columns.index:
+            matrix.rows[fixtureId] = matrix.rows.get(fixtureId, 0) | 1 << columns.index[unitId]
+    return matrix
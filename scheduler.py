@@ -0,0 +1,119 @@
+import random
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Deque, Dict
+
+import config
+
+WRITE_METHODS = {'add_worksheet', 'append_row', 'append_rows', 'batch_clear', 'batch_update', 'clear',
+                 'delete_rows', 'format', 'insert_row', 'insert_rows', 'resize', 'update', 'update_cell',
+                 'update_cells', 'update_title', 'values_update'}
+PLAIN_TYPES = (type(None), bool, int, float, str, bytes, dict, list, tuple)
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+def get_status_code(e: Exception) -> int | None:
+    '''Returns the HTTP status code of a failed API call, if there is one.'''
+    code = getattr(e, 'code', None)
+    if isinstance(code, int):
+        return code
+    response = getattr(e, 'response', None)
+    return getattr(response, 'status_code', None)
+
+
+class RequestScheduler:
+    '''Paces Google API calls to stay inside the per-minute quotas and retries rate limited or failed requests.
+
+    Reads and writes are tracked against separate sliding one minute windows, matching how the Sheets API
+    meters them. Requests that fail with 429 or 5xx are retried with jittered exponential backoff.'''
+
+    def __init__(self,
+                 readQuota: int = config.SHEETS_READ_REQUESTS_PER_MINUTE,
+                 writeQuota: int = config.SHEETS_WRITE_REQUESTS_PER_MINUTE,
+                 maxRetries: int = config.SHEETS_MAX_RETRIES,
+                 maxBackoff: float = 64.0,
+                 window: float = 60.0):
+        self.quotas = {'read': readQuota, 'write': writeQuota}
+        self.history: Dict[str, Deque[float]] = {'read': deque(), 'write': deque()}
+        self.maxRetries = maxRetries
+        self.maxBackoff = maxBackoff
+        self.window = window
+        self.lock = threading.Lock()
+
+        self.calls = 0
+        self.retries = 0
+        self.pacedSeconds = 0.0
+        self.backoffSeconds = 0.0
+
+    @property
+    def waited(self) -> float:
+        '''Total seconds spent waiting on quota or backing off.'''
+        return self.pacedSeconds + self.backoffSeconds
+
+    def acquire(self, kind: str):
+        '''Blocks until a request of the given kind fits in the quota window, then reserves a slot for it.'''
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                history = self.history[kind]
+                while history and now - history[0] >= self.window:
+                    history.popleft()
+
+                if len(history) < self.quotas[kind]:
+                    history.append(now)
+                    self.calls += 1
+                    return
+
+                delay = self.window - (now - history[0])
+                self.pacedSeconds += delay
+
+            time.sleep(delay)
+
+    def call(self, kind: str, fn: Callable, *args, **kwargs) -> Any:
+        '''Calls fn once a quota slot is available, retrying 429 and 5xx errors.'''
+        attempt = 0
+        while True:
+            self.acquire(kind)
+            try:
+                return fn(*args, **kwargs)
+            except Exception as e:
+                if get_status_code(e) not in RETRY_STATUS_CODES or attempt >= self.maxRetries:
+                    raise
+
+                delay = min(self.maxBackoff, 2 ** attempt + random.random())
+                with self.lock:
+                    self.retries += 1
+                    self.backoffSeconds += delay
+                attempt += 1
+                time.sleep(delay)
+
+    def wrap(self, target: Any) -> Any:
+        '''Wraps an API object so that every method call on it goes through the scheduler.'''
+        if isinstance(target, PLAIN_TYPES):
+            return target
+        return ScheduledProxy(target, self)
+
+    def summary(self) -> str:
+        return f'{self.calls} API calls, {self.retries} retries, waited {self.waited:.1f}s ({self.pacedSeconds:.1f}s pacing, {self.backoffSeconds:.1f}s backoff)'
+
+
+class ScheduledProxy:
+    '''Forwards attribute access to the wrapped object, routing method calls through a RequestScheduler.
+    Objects returned from those calls, such as worksheets, are wrapped as well.'''
+
+    def __init__(self, target: Any, scheduler: RequestScheduler):
+        self._target = target
+        self._scheduler = scheduler
+
+    def __getattr__(self, name: str) -> Any:
+        attr = getattr(self._target, name)
+        if not callable(attr):
+            return attr
+
+        kind = 'write' if name in WRITE_METHODS else 'read'
+
+        def scheduled(*args, **kwargs):
+            return self._scheduler.wrap(self._scheduler.call(kind, attr, *args, **kwargs))
+
+        return scheduled
@@ -0,0 +1,255 @@
+import argparse
+import hashlib
+import json
+import tempfile
+import zlib
+from datetime import datetime
+from typing import Dict, Iterator, List, Tuple
+
+from sqlalchemy import create_engine, delete, select
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Session, selectinload, sessionmaker
+
+import config
+from model import Base, Card, ExportSnapshot, GameCharacter, ImportInfo, Music
+
+# Bump when the layout of exported rows changes so that old snapshots are not reused
+SNAPSHOT_FORMAT_VERSION = 1
+EXPORT_MODELS = {
+    'cards': Card,
+    'musics': Music,
+}
+# Relationships used by asdict(), loaded a batch at a time alongside the rows
+EXPORT_LOADERS = {
+    'cards': [
+        selectinload(Card.character).selectinload(GameCharacter.unit),
+        selectinload(Card.supportUnit),
+        selectinload(Card.skill),
+        selectinload(Card.cardSupply),
+        selectinload(Card.sideStories),
+    ],
+    'musics': [
+        selectinload(Music.creatorArtist),
+        selectinload(Music.difficulties),
+        selectinload(Music.tags),
+        selectinload(Music.videoLink),
+    ],
+}
+
+Rows = Tuple[List[str], List[List]]
+
+
+def new_run_id() -> str:
+    return datetime.now().strftime('%Y%m%d-%H%M%S-%f')
+
+
+def create_snapshot_table(engine):
+    Base.metadata.create_all(engine, tables=[ExportSnapshot.__table__])  # type: ignore
+
+
+def get_source_key(session: Session) -> str | None:
+    '''Returns a key identifying the imported data that exports are built from, or None if it is unknown.'''
+    try:
+        info = session.get(ImportInfo, 1)
+    except OperationalError:
+        return None
+    if info is None:
+        return None
+
+    source = f'{SNAPSHOT_FORMAT_VERSION}|{info.importedAt.isoformat()}|{info.enCommit}|{info.jpCommit}'
+    return hashlib.sha256(source.encode('utf8')).hexdigest()
+
+
+class SnapshotWriter:
+    '''Compresses and hashes exported rows as they are produced. The first line of the snapshot is the headers,
+    followed by one JSON array per row. The compressed data is spooled to a temp file, so only the finished snapshot
+    is read into memory, and only if it is saved.'''
+
+    def __init__(self, name: str, headers: List[str], runId: str, sourceKey: str | None):
+        self.name = name
+        self.runId = runId
+        self.sourceKey = sourceKey
+        self.rowCount = 0
+        self.hash = hashlib.sha256()
+        self.compressor = zlib.compressobj(9)
+        self.file = tempfile.TemporaryFile()
+        self._write(headers)
+
+    def _write(self, value: List):
+        line = json.dumps(value, ensure_ascii=False, default=str).encode('utf8') + b'\n'
+        self.hash.update(line)
+        self.file.write(self.compressor.compress(line))
+
+    def add(self, row: List):
+        self._write(row)
+        self.rowCount += 1
+
+    def save(self, session: Session) -> ExportSnapshot:
+        '''Saves the snapshot and prunes old ones. Returns the latest snapshot built from the same import instead if it
+        has the same contents.'''
+        latest = session.execute(select(ExportSnapshot).where(
+            ExportSnapshot.name == self.name,
+            ExportSnapshot.formatVersion == SNAPSHOT_FORMAT_VERSION,
+            ExportSnapshot.sourceKey == self.sourceKey
+        ).order_by(ExportSnapshot.id.desc()).limit(1)).scalar()
+        if latest is not None and latest.contentHash == self.hash.hexdigest():
+            self.file.close()
+            return latest
+
+        self.file.write(self.compressor.flush())
+        self.file.seek(0)
+        snapshot = ExportSnapshot(
+            runId=self.runId,
+            name=self.name,
+            createdAt=datetime.now(),
+            formatVersion=SNAPSHOT_FORMAT_VERSION,
+            sourceKey=self.sourceKey,
+            contentHash=self.hash.hexdigest(),
+            rowCount=self.rowCount,
+            data=self.file.read()
+        )
+        self.file.close()
+        session.add(snapshot)
+        session.flush()
+        prune_snapshots(session, self.name)
+        session.commit()
+        return snapshot
+
+
+def prune_snapshots(session: Session, name: str, keep: int | None = config.EXPORT_SNAPSHOT_RETENTION):
+    '''Deletes all but the newest snapshots of a table.'''
+    if keep is None:
+        return
+    old = select(ExportSnapshot.id).where(ExportSnapshot.name == name).order_by(ExportSnapshot.id.desc()).offset(keep)
+    session.execute(delete(ExportSnapshot).where(ExportSnapshot.id.in_(old)))
+
+
+def read_snapshot(snapshot: ExportSnapshot) -> Rows:
+    lines = zlib.decompress(snapshot.data).decode('utf8').splitlines()
+    return json.loads(lines[0]), [json.loads(l) for l in lines[1:]]
+
+
+def latest_snapshot(session: Session, name: str, sourceKey: str | None = None) -> ExportSnapshot | None:
+    '''Returns the most recent snapshot of a table, optionally only if it was built from the given source.'''
+    query = select(ExportSnapshot).where(
+        ExportSnapshot.name == name,
+        ExportSnapshot.formatVersion == SNAPSHOT_FORMAT_VERSION
+    )
+    if sourceKey is not None:
+        query = query.where(ExportSnapshot.sourceKey == sourceKey)
+    return session.execute(query.order_by(ExportSnapshot.id.desc()).limit(1)).scalar()
+
+
+def iter_rows(session: Session, name: str, yieldPer: int = config.EXPORT_BATCH_SIZE) -> Iterator[List]:
+    '''Yields the rows of an export table, fetching yieldPer objects at a time.'''
+    model = EXPORT_MODELS[name]
+    query = select(model).order_by(model.id).options(*EXPORT_LOADERS[name]).execution_options(yield_per=yieldPer)
+    for item in session.execute(query).scalars():
+        yield item.to_row()
+
+
+def build_rows(session: Session, name: str) -> Rows:
+    return list(EXPORT_MODELS[name].ROW_HEADERS), list(iter_rows(session, name))
+
+
+def stream_export_rows(sessionFactory: sessionmaker, snapshot: SnapshotWriter) -> Iterator[List]:
+    '''Yields the rows of an export table as they are loaded, adding each to the snapshot. The snapshot isn't saved, so
+    that callers reading several tables at once can save them after every read has finished.'''
+    with sessionFactory() as session:
+        for row in iter_rows(session, snapshot.name):
+            snapshot.add(row)
+            yield row
+
+
+def get_export_rows(sessionFactory: sessionmaker, name: str, runId: str, mode: str | None = None) -> Rows:
+    '''Returns the headers and rows of an export table, saving them as a snapshot.
+
+    With mode 'reuse', the latest snapshot built from the same import is returned instead if there is one.
+    With mode 'latest', the latest snapshot is returned regardless of what it was built from.'''
+    with sessionFactory() as session:
+        sourceKey = get_source_key(session)
+
+        if mode in ('reuse', 'latest'):
+            snapshot = latest_snapshot(session, name, sourceKey if mode == 'reuse' else None)
+            if snapshot is not None and (mode == 'latest' or sourceKey is not None):
+                print(f'Using {name} snapshot from run {snapshot.runId}.')
+                return read_snapshot(snapshot)
+            if mode == 'latest':
+                raise LookupError(f'No {name} snapshot to fall back to.')
+
+        headers, rows = build_rows(session, name)
+        writer = SnapshotWriter(name, headers, runId, sourceKey)
+        for row in rows:
+            writer.add(row)
+        writer.save(session)
+        return headers, rows
+
+
+def diff_snapshots(old: Rows, new: Rows) -> Dict[str, List]:
+    '''Compares two snapshots by their first column. Returns the added and removed row keys and
+    a (key, header, old, new) tuple for each changed cell.'''
+    oldHeaders, oldRows = old
+    newHeaders, newRows = new
+    oldByKey = {r[0]: dict(zip(oldHeaders, r)) for r in oldRows}
+    newByKey = {r[0]: dict(zip(newHeaders, r)) for r in newRows}
+
+    changed = []
+    for key in oldByKey.keys() & newByKey.keys():
+        o, n = oldByKey[key], newByKey[key]
+        for header in dict.fromkeys([*oldHeaders, *newHeaders]):
+            if o.get(header) != n.get(header):
+                changed.append((key, header, o.get(header), n.get(header)))
+
+    return {
+        'added': sorted(newByKey.keys() - oldByKey.keys()),
+        'removed': sorted(oldByKey.keys() - newByKey.keys()),
+        'changed': sorted(changed, key=lambda c: c[0]),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog='snapshot',
+        description='Lists and compares saved export snapshots.'
+    )
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    listParser = subparsers.add_parser('list', help='List saved snapshots.')
+    listParser.add_argument('name', nargs='?', help='Only list snapshots of this table.')
+    diffParser = subparsers.add_parser(
+        'diff', help='Show the cells that changed between two snapshots. Defaults to the two most recent snapshots of the table.')
+    diffParser.add_argument('name', choices=EXPORT_MODELS.keys())
+    diffParser.add_argument('old', nargs='?', type=int, help='ID of the older snapshot.')
+    diffParser.add_argument('new', nargs='?', type=int, help='ID of the newer snapshot.')
+    args = vars(parser.parse_args())
+
+    engine = create_engine(config.DATABASE_STRING)
+    create_snapshot_table(engine)
+    Session = sessionmaker(bind=engine)
+    session = Session()
+
+    if args['command'] == 'list':
+        query = select(ExportSnapshot).order_by(ExportSnapshot.id)
+        if args.get('name'):
+            query = query.where(ExportSnapshot.name == args['name'])
+        for s in session.execute(query).scalars():
+            print(f'{s.id:>6}  {s.name:<10}{s.runId:<26}{s.rowCount:>8} rows  {s.contentHash[:12]}  {len(s.data):>10} bytes')
+    else:
+        if args.get('old') and args.get('new'):
+            snapshots = [session.get(ExportSnapshot, args['old']), session.get(ExportSnapshot, args['new'])]
+        else:
+            snapshots = list(reversed(session.execute(
+                select(ExportSnapshot).where(ExportSnapshot.name == args['name']).order_by(ExportSnapshot.id.desc()).limit(2)
+            ).scalars().all()))
+
+        if len(snapshots) < 2 or None in snapshots:
+            print('Need two snapshots to compare.')
+        elif snapshots[0].contentHash == snapshots[1].contentHash:  # type: ignore
+            print('No changes.')
+        else:
+            diff = diff_snapshots(read_snapshot(snapshots[0]), read_snapshot(snapshots[1]))  # type: ignore
+            for key in diff['added']:
+                print(f'+ {key}')
+            for key in diff['removed']:
+                print(f'- {key}')
+            for key, header, old, new in diff['changed']:
+                print(f'~ {key} {header}: {old!r} -> {new!r}')
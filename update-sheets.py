@@ -1,124 +1,260 @@
 import argparse
-import glob
+import json
 import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from functools import cache, partial
 from itertools import groupby
-from typing import List
+from time import perf_counter
+from typing import Any, Callable, Dict, List, Tuple
 
 import gspread
-from sqlalchemy import create_engine, select
+from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 
 import config
 from data import update_data
-from model import Card, Music
+from fake_sheets import FakeClient, RequestRecord
+from scheduler import RequestScheduler
+from manifest import BakedTitle, load_manifest
+from model import HonorType
+from snapshot import Rows, create_snapshot_table, get_export_rows, new_run_id
 
 GITHUB_BASE_URL = r'https://raw.githubusercontent.com/yhsanave/prsk-sheet-assets/refs/heads/main'
-CR_TITLES_PATH = os.path.join(
-    config.ASSETS_DIRECTORY, 'honor_baked', 'character')
-ACHIEVEMENT_TITLES_PATH = os.path.join(
-    config.ASSETS_DIRECTORY, 'honor_baked', 'achievement')
-
-parser = argparse.ArgumentParser(
-    prog='update-sheets',
-    description='Updates the master spreadsheet with the latest data.'
-)
-parser.add_argument('-nu', '--no-update', action='store_true',
-                    help='Skip updating the DB. Use this if you have already pulled the DB.')
-args = vars(parser.parse_args())
-
-# Get latest data
-if not args.get('no_update'):
-    update_data()
-
-# Database Setup
-engine = create_engine(config.DATABASE_STRING)
-Session = sessionmaker(bind=engine)
-session = Session()
-
-# Google Sheets Setup
-gc = gspread.service_account(filename=config.GOOGLE_API_KEY_PATH)
-masterSpread = gc.open_by_key(config.MASTER_SHEET_ID)
-
-# Get Cards
-cards = session.execute(select(Card).order_by(Card.id)).scalars().all()
-cardRows: List[List] = [c.to_row() for c in cards]
-cardHeaders = cards[0].get_row_headers()
-
-# Get Musics
-musics = session.execute(select(Music).order_by(Music.id)).scalars().all()
-musicRows: List[List] = [m.to_row() for m in musics]
-musicHeaders = musics[0].get_row_headers()
-
-# Write Sheets
-print('Writing Cards sheet...')
-cardSheet = masterSpread.worksheet('Cards')
-cardSheet.clear()
-cardSheet.update([cardHeaders], 'A1')
-cardSheet.update(cardRows, 'A2')
-
-print('Writing Musics sheet...')
-musicSheet = masterSpread.worksheet('Musics')
-musicSheet.clear()
-musicSheet.update([musicHeaders], 'A1')
-musicSheet.update(musicRows, 'A2')
-
-print('Writing Musics Fixed sheet...')
-musicFixedSheet = masterSpread.worksheet('Musics Fixed')
-musicFixedSheet.clear()
-musicFixedSheet.update([musicHeaders], 'A1')
-# To avoid desyncing data when new songs are inserted between existing IDs, leave gaps in the sheet
-musicFixedRows = [[] for _ in range(musicRows[-1][0])]
-for row in musicRows:
-    musicFixedRows[row[0]-1] = row
-musicFixedSheet.update(musicFixedRows, 'A2')
-
-# CR Titles
-print("Writing CR Titles sheet...")
-crTitleSheet = masterSpread.worksheet("CR Titles")
-crTitleSheet.clear()
-crTitleSheet.update([['Main', *range(0, 165, 5)]], 'A1')
-
-crDegrees = glob.glob('**/main/*.png', root_dir=CR_TITLES_PATH, recursive=True)
-rows = []
-for k, g in groupby(crDegrees, lambda p: p.split(os.path.sep)[0]):
-    rows.append([
-        k[3:].replace('-', ' '),
-        *[f'{GITHUB_BASE_URL}/honor_baked/character/{p.replace(os.path.sep, "/")}' for p in g]
-    ])
-crTitleSheet.update(rows, 'A2', value_input_option='USER_ENTERED') # type: ignore
-
-crTitleSheet.update([['Sub', *range(0, 165, 5)]], 'A28')
-crDegrees = glob.glob('**/sub/*.png', root_dir=CR_TITLES_PATH, recursive=True)
-rows = []
-for k, g in groupby(crDegrees, lambda p: p.split(os.path.sep)[0]):
-    rows.append([
-        k[3:].replace('-', ' '),
-        *[f'{GITHUB_BASE_URL}/honor_baked/character/{p.replace(os.path.sep, "/")}' for p in g]
-    ])
-crTitleSheet.update(rows, 'A29', value_input_option='USER_ENTERED') # type: ignore
-
-# Achievement Titles
-print("Writing Achievement sheets...")
-achievementSheetMain = masterSpread.worksheet("Achievements Main")
-achievementDegreesMain = glob.glob(
-    '**/main/*.png', root_dir=ACHIEVEMENT_TITLES_PATH, recursive=True)
-rows = []
-for k, g in groupby(achievementDegreesMain, lambda p: p.split(os.path.sep)[0]):
-    rows.append([
-        k[5:].replace('-', ' '),
-        *[f'{GITHUB_BASE_URL}/honor_baked/achievement/{p.replace(os.path.sep, "/")}' for p in g]
-    ])
-achievementSheetMain.clear()
-achievementSheetMain.update(rows, 'A1', value_input_option='USER_ENTERED') # type: ignore
-
-achievementSheetSub = masterSpread.worksheet("Achievements Sub")
-achievementDegreesSub = glob.glob(
-    '**/sub/*.png', root_dir=ACHIEVEMENT_TITLES_PATH, recursive=True)
-rows = []
-for k, g in groupby(achievementDegreesSub, lambda p: p.split(os.path.sep)[0]):
-    rows.append([
-        k[5:].replace('-', ' '),
-        *[f'{GITHUB_BASE_URL}/honor_baked/achievement/{p.replace(os.path.sep, "/")}' for p in g]
+
+SheetUpdates = List[Tuple[str, List[List]]]
+
+
+@dataclass
+class SheetJob:
+    name: str
+    build: Callable[[], Any]
+    write: Callable[[Any, Any], None]
+
+
+@dataclass
+class SheetResult:
+    name: str
+    buildSeconds: float = 0.0
+    writeSeconds: float = 0.0
+    error: Exception | None = None
+
+
+rowsLocks: Dict[str, threading.Lock] = {}
+
+
+@cache
+def _get_rows(sessionFactory: sessionmaker, name: str, runId: str, mode: str | None) -> Rows:
+    return get_export_rows(sessionFactory, name, runId, mode)
+
+
+def get_rows(sessionFactory: sessionmaker, name: str, runId: str, mode: str | None) -> Rows:
+    '''Returns the headers and rows of an export table. Each table is loaded once per run and shared between sheets.'''
+    with rowsLocks.setdefault(name, threading.Lock()):
+        return _get_rows(sessionFactory, name, runId, mode)
+
+
+def build_cards(loadRows: Callable[[str], Rows]) -> SheetUpdates:
+    cardHeaders, cardRows = loadRows('cards')
+    return [('A1', [cardHeaders]), ('A2', cardRows)]
+
+
+def build_musics(loadRows: Callable[[str], Rows]) -> SheetUpdates:
+    musicHeaders, musicRows = loadRows('musics')
+    return [('A1', [musicHeaders]), ('A2', musicRows)]
+
+
+def build_musics_fixed(loadRows: Callable[[str], Rows]) -> Rows:
+    return loadRows('musics')
+
+
+def get_id_runs(ids: List[int]) -> List[Tuple[int, int]]:
+    '''Groups sorted IDs into (first, last) runs of consecutive values.'''
+    runs = []
+    for _, g in groupby(enumerate(ids), lambda x: x[1] - x[0]):
+        run = [i for _, i in g]
+        runs.append((run[0], run[-1]))
+    return runs
+
+
+def write_musics_fixed(sheet, payload: Rows):
+    '''Writes each song to the row matching its ID. Only runs of consecutive IDs are sent, and the gaps
+    between them are left alone unless a song that used to be there has been removed.'''
+    musicHeaders, musicRows = payload
+    ids = [row[0] for row in musicRows]
+    # The API skips null cells rather than blanking them, so send '' to clear values that have gone
+    rowsById = {row[0]: ['' if v is None else v for v in row] for row in musicRows}
+
+    # Row n+1 holds music n, so anything left in a row whose ID is no longer in the data is stale
+    current = set(ids)
+    existing = sheet.col_values(1)[1:]
+    removed = [i for i, v in enumerate(existing, 1) if str(v).strip() and i not in current]
+    if removed:
+        sheet.batch_clear([f'{first+1}:{last+1}' for first, last in get_id_runs(removed)])
+
+    sheet.batch_update([
+        {'range': 'A1', 'values': [musicHeaders]},
+        *[{'range': f'A{first+1}', 'values': [rowsById[i] for i in range(first, last+1)]}
+          for first, last in get_id_runs(ids)]
     ])
-achievementSheetSub.clear()
-achievementSheetSub.update(rows, 'A1', value_input_option='USER_ENTERED') # type: ignore
+
+
+@cache
+def get_titles() -> List[BakedTitle]:
+    return load_manifest()
+
+
+def get_title_rows(honorType: HonorType, size: str) -> List[List]:
+    '''Returns a row of baked title URLs for each honor group, in manifest order.'''
+    titles = [t for t in get_titles() if t.honorType == honorType.value and t.size == size]
+    rows = []
+    for _, g in groupby(titles, lambda t: t.groupId):
+        g = list(g)
+        rows.append([
+            g[0].label,
+            *[f'{GITHUB_BASE_URL}/honor_baked/{t.file}' for t in g]
+        ])
+    return rows
+
+
+def build_cr_titles() -> SheetUpdates:
+    return [
+        ('A1', [['Main', *range(0, 165, 5)]]),
+        ('A2', get_title_rows(HonorType.CHARACTER, 'main')),
+        ('A28', [['Sub', *range(0, 165, 5)]]),
+        ('A29', get_title_rows(HonorType.CHARACTER, 'sub')),
+    ]
+
+
+def build_achievements(size: str) -> SheetUpdates:
+    return [('A1', get_title_rows(HonorType.ACHIEVEMENT, size))]
+
+
+def write_sheet(sheet, updates: SheetUpdates, valueInputOption: str | None = None):
+    '''Clears the sheet and writes each block of rows at its range.'''
+    sheet.clear()
+    for rangeName, values in updates:
+        sheet.update(values, rangeName, value_input_option=valueInputOption)  # type: ignore
+
+
+def run_job(spreadsheet, job: SheetJob) -> SheetResult:
+    '''Builds and writes a single worksheet. Errors are captured so they don't affect other sheets.'''
+    result = SheetResult(job.name)
+    try:
+        start = perf_counter()
+        payload = job.build()
+        result.buildSeconds = perf_counter() - start
+
+        start = perf_counter()
+        job.write(spreadsheet.worksheet(job.name), payload)
+        result.writeSeconds = perf_counter() - start
+    except Exception as e:
+        result.error = e
+    print(f'{"Failed" if result.error else "Wrote"} {job.name} sheet.')
+    return result
+
+
+def print_summary(results: List[SheetResult], wallSeconds: float):
+    print(f'{"Sheet":<20}{"Build":>8}{"Write":>8}{"Total":>8}  Status')
+    for r in results:
+        print(f'{r.name:<20}{r.buildSeconds:>8.2f}{r.writeSeconds:>8.2f}{r.buildSeconds + r.writeSeconds:>8.2f}  {r.error or "OK"}')
+    print(f'Finished {len(results)} sheets in {wallSeconds:.2f}s')
+
+
+def export_plan(results: List[SheetResult], client: FakeClient, directory: str):
+    '''Writes the requests each sheet would send to a JSON file per sheet and prints their statistics.'''
+    os.makedirs(directory, exist_ok=True)
+
+    print(f'{"Sheet":<20}{"Rows":>8}{"Cells":>10}{"Bytes":>12}{"Calls":>8}{"Build":>8}')
+    for r in results:
+        records: List[RequestRecord] = client.worksheet_records(r.name)
+        with open(os.path.join(directory, f'{r.name}.json'), 'w', encoding='utf8') as f:
+            json.dump([{'method': rec.method, 'ranges': rec.ranges, 'body': rec.body} for rec in records],
+                      f, default=str, ensure_ascii=False)
+
+        print(f'{r.name:<20}{sum(rec.rows for rec in records):>8}{sum(rec.cells for rec in records):>10}'
+              f'{sum(rec.bytes for rec in records):>12}{len(records):>8}{r.buildSeconds:>8.2f}')
+    print(f'Wrote request plans to {directory}')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog='update-sheets',
+        description='Updates the master spreadsheet with the latest data.'
+    )
+    parser.add_argument('-nu', '--no-update', action='store_true',
+                        help='Skip updating the DB. Use this if you have already pulled the DB.')
+    parser.add_argument('--offline', action='store_true',
+                        help='Write to an in-memory stand-in for Google Sheets instead of the master sheet and print request statistics.')
+    parser.add_argument('--offline-latency', type=float, default=0.0,
+                        help='Simulated round trip time in seconds for each request in offline mode.')
+    parser.add_argument('--offline-error-rate', type=float, default=0.0,
+                        help='Fraction of requests that fail with a simulated 429 in offline mode.')
+    parser.add_argument('--offline-dump', type=str, default=None,
+                        help='Path to write the offline sheet state and request log to as JSON.')
+    parser.add_argument('--dry-run', type=str, nargs='?', const=os.path.join('output', 'dry-run'), default=None,
+                        help='Build every sheet without contacting Google and write the requests that would be sent to this directory.')
+    parser.add_argument('--reuse-snapshot', action='store_true',
+                        help='Reuse the last exported card and music rows if they were built from the same import.')
+    parser.add_argument('-j', '--jobs', type=int, default=config.SHEETS_MAX_WORKERS,
+                        help='Number of worksheets to build and write at the same time.')
+    args = vars(parser.parse_args())
+
+    # Get latest data. If the import fails, fall back to the last exported rows.
+    snapshotMode = 'reuse' if args.get('reuse_snapshot') else None
+    if not args.get('no_update'):
+        try:
+            update_data()
+        except Exception as e:
+            print(f'Failed to update data, using the latest snapshot instead: {e}')
+            snapshotMode = 'latest'
+
+    # Database Setup
+    engine = create_engine(config.DATABASE_STRING)
+    create_snapshot_table(engine)
+    Session = sessionmaker(bind=engine)
+    loadRows = partial(get_rows, Session, runId=new_run_id(), mode=snapshotMode)
+
+    # Google Sheets Setup
+    if args.get('dry_run'):
+        client = FakeClient(keepBodies=True)
+    elif args.get('offline'):
+        client = FakeClient(latency=args['offline_latency'],
+                            errorRate=args['offline_error_rate'])
+    else:
+        client = gspread.service_account(filename=config.GOOGLE_API_KEY_PATH)
+    scheduler = RequestScheduler()
+    gc = scheduler.wrap(client)
+    masterSpread = gc.open_by_key(config.MASTER_SHEET_ID)
+
+    # Build and write each sheet concurrently
+    jobs = [
+        SheetJob('Cards', partial(build_cards, loadRows), write_sheet),
+        SheetJob('Musics', partial(build_musics, loadRows), write_sheet),
+        SheetJob('Musics Fixed', partial(build_musics_fixed, loadRows), write_musics_fixed),
+        SheetJob('CR Titles', build_cr_titles,
+                 partial(write_sheet, valueInputOption='USER_ENTERED')),
+        SheetJob('Achievements Main', partial(build_achievements, 'main'),
+                 partial(write_sheet, valueInputOption='USER_ENTERED')),
+        SheetJob('Achievements Sub', partial(build_achievements, 'sub'),
+                 partial(write_sheet, valueInputOption='USER_ENTERED')),
+    ]
+
+    start = perf_counter()
+    with ThreadPoolExecutor(max_workers=max(1, min(args['jobs'], len(jobs)))) as pool:
+        results = list(pool.map(partial(run_job, masterSpread), jobs))
+    print_summary(results, perf_counter() - start)
+
+    if args.get('dry_run'):
+        export_plan(results, client, args['dry_run'])  # type: ignore
+    else:
+        print(scheduler.summary())
+        if isinstance(client, FakeClient):
+            print(client.summary())
+            if args.get('offline_dump'):
+                client.dump(args['offline_dump'])
+
+    if any(r.error for r in results):
+        sys.exit(1)